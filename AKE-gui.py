@@ -1,4 +1,6 @@
 import sys
+import threading
+import Queue
 from Tkinter import *
 from tkFileDialog import askopenfilename
 from tkFileDialog import askdirectory
@@ -16,16 +18,23 @@ class Application(Frame):
         self.text.delete(1.0, END)
 
     def set_keyphrases(self):
+        if self.keyphrases is None:
+            return
         self.clear_keyphrases()
         total_weight = float(self.weight_entry.get())
-        keyphrases = KeyphraseExtractor.get_top_keyphrases(self.keyphrases, total_weight)
-        if self.clusterize_var.get():
-            self.clusters = KeyphraseExtractor.clusterize(keyphrases)
-        content = 'Keyphrase extraction elapsed time: {:.9f} seconds\n'.format(self.time_elapsed)
-        if self.clusterize_var.get():
-            content += System.get_clustered_keyphrases_string(self.clusters)
-        else:
-            content += System.get_keyphrases_string(keyphrases)
+        # weights selecting the same number of top keyphrases show the same content
+        content_key = (self.keyphrases.get_top_count(total_weight), self.clusterize_var.get())
+        content = self.keyphrases_contents.get(content_key)
+        if content is None:
+            keyphrases = self.keyphrases.get_top(total_weight)
+            if self.clusterize_var.get():
+                self.clusters = KeyphraseExtractor.clusterize(keyphrases)
+            content = 'Keyphrase extraction elapsed time: {:.9f} seconds\n'.format(self.time_elapsed)
+            if self.clusterize_var.get():
+                content += System.get_clustered_keyphrases_string(self.clusters)
+            else:
+                content += System.get_keyphrases_string(keyphrases)
+            self.keyphrases_contents[content_key] = content
         self.text.insert(END, content)
         self.text.configure(state="disabled")
 
@@ -51,44 +60,34 @@ class Application(Frame):
             return
 
     def extract_file_command(self):
-        self.clear_keyphrases()
-        self.after(1, self.extract_file)
-
-    def extract_file(self):
         if self.file_path:
-            provider = FileContentProvider(self.file_path)
-            extractor = KeyphraseExtractor(provider)
-
-            self.extract(extractor)
+            self.extract_command(FileContentProvider(self.file_path))
 
     def extract_dir_command(self):
-        self.clear_keyphrases()
-        self.after(1, self.extract_dir)
-
-    def extract_dir(self):
         if self.dir_path:
-            provider = DirectoryContentProvider(self.dir_path)
-            extractor = KeyphraseExtractor(provider)
-
-            self.extract(extractor)
+            self.extract_command(DirectoryContentProvider(self.dir_path))
 
     def extract_wiki_command(self):
-        self.clear_keyphrases()
-        self.after(1, self.extract_wiki)
-
-    def extract_wiki(self):
         self.wiki_titles = self.wiki_entry.get()
         if self.wiki_titles:
-            provider = WikipediaContentProvider(self.wiki_titles)
-            extractor = KeyphraseExtractor(provider)
-            
-            self.extract(extractor)
+            self.extract_command(WikipediaContentProvider(self.wiki_titles, self.wiki_cache))
 
-    def extract(self, extractor):
+    def extract_command(self, provider):
+        self.clear_keyphrases()
+        self.start_job(lambda progress: self.extract(KeyphraseExtractor(provider, result_cache=self.result_cache,
+                                                                        progress=progress)),
+                       self.set_extraction)
+
+    @staticmethod
+    def extract(extractor):
         time_start = time.time()
-        self.keyphrases = extractor.extract_keyphrases_by_textrank()
+        keyphrases = extractor.extract_keyphrases_by_textrank()
         time_end = time.time()
-        self.time_elapsed = time_end - time_start
+        return keyphrases, time_end - time_start
+
+    def set_extraction(self, extraction):
+        self.keyphrases, self.time_elapsed = extraction
+        self.keyphrases_contents = {}
         self.set_keyphrases()
 
     def apply(self):
@@ -106,49 +105,65 @@ class Application(Frame):
             return
 
     def find_similar_command(self):
-        self.clear_similarities()
-        self.after(1, self.find_similar)
+        if self.primary_file_path:
+            self.clear_similarities()
+            primary_file_path = self.primary_file_path
+            self.start_job(lambda progress: self.find_similar(primary_file_path, progress), self.set_similar)
 
+    def find_similar(self, primary_file_path, progress):
+        main_provider = FileContentProvider(primary_file_path)
 
-    def find_similar(self):
-        main_provider = FileContentProvider(self.primary_file_path)
-        main_extractor = KeyphraseExtractor(main_provider)
-
-        master_dir_path = os.path.dirname(self.primary_file_path)
-        excluded_path = os.path.basename(self.primary_file_path)
+        master_dir_path = os.path.dirname(primary_file_path)
+        excluded_path = os.path.basename(primary_file_path)
         comparison_file_paths = DirectoryContentLister(master_dir_path, excluded_path).get_content_list()
         file_providers = []
         for path in comparison_file_paths:
             file_providers.append(FileContentProvider(path))
-        comparison_extractor = MultipleProvidersKeyphraseExtractor(file_providers)
-
-        keyphrases = main_extractor.extract_keyphrases_by_textrank()
-        self.similarity_top_keyphrases = main_extractor.get_top_keyphrases(keyphrases, 0.2)
-
-        self.similarity_comparison_keyphrases_map = comparison_extractor.extract_keyphrases_map_by_textrank()
-
-        self.set_similarities()
+        # master and compared files are tagged together in batches
+        extractor = BatchKeyphraseExtractor([main_provider] + file_providers, result_cache=self.result_cache,
+                                            progress=progress)
+        keyphrases_map = extractor.extract_keyphrases_map_by_textrank()
+
+        keyphrases = keyphrases_map.pop(main_provider.get_title())
+        if keyphrases is None:
+            raise ContentProviderException()
+        top_keyphrases = KeyphraseExtractor.get_top_keyphrases(keyphrases, 0.2)
+
+        comparison_keyphrases_map = {}
+        for title, cmp_keyphrases in keyphrases_map.iteritems():
+            if cmp_keyphrases is not None:
+                comparison_keyphrases_map[title] = KeyphraseExtractor.get_top_keyphrases(cmp_keyphrases, 0.2)
+        return top_keyphrases, comparison_keyphrases_map
 
     def find_similar_wiki_command(self):
-        self.clear_similarities()
-        self.after(1, self.find_similar_wiki)
+        title = self.similar_wiki_entry.get()
+        if title:
+            self.clear_similarities()
+            self.start_job(lambda progress: self.find_similar_wiki(title, progress), self.set_similar)
 
-    def find_similar_wiki(self):
-        main_provider = WikipediaContentProvider(self.similar_wiki_entry.get())
-        main_extractor = KeyphraseExtractor(main_provider)
+    def find_similar_wiki(self, title, progress):
+        main_provider = WikipediaContentProvider(title, self.wiki_cache)
+        main_extractor = KeyphraseExtractor(main_provider, result_cache=self.result_cache, progress=progress)
 
-        page = WikipediaPageFinder(self.similar_wiki_entry.get()).get_wikipedia_page()
+        progress.report('finding page')
+        page = WikipediaPageFinder(title).get_wikipedia_page()
         links = page.links
+        contents = WikipediaPagesFetcher(cache=self.wiki_cache, progress=progress).fetch_all(links)
         link_page_providers = []
         for link in links:
-            link_page_providers.append(WikipediaContentProvider(link))
-        comparison_extractor = MultipleProvidersKeyphraseExtractor(link_page_providers)
+            if link in contents:
+                link_page_providers.append(TextContentProvider(link, contents[link]))
+        comparison_extractor = MultipleProvidersKeyphraseExtractor(link_page_providers,
+                                                                   result_cache=self.result_cache,
+                                                                   progress=progress)
 
         keyphrases = main_extractor.extract_keyphrases_by_textrank()
-        self.similarity_top_keyphrases = main_extractor.get_top_keyphrases(keyphrases, 0.2)
+        top_keyphrases = main_extractor.get_top_keyphrases(keyphrases, 0.2)
 
-        self.similarity_comparison_keyphrases_map = comparison_extractor.extract_keyphrases_map_by_textrank()
+        return top_keyphrases, comparison_extractor.extract_keyphrases_map_by_textrank()
 
+    def set_similar(self, similar):
+        self.similarity_top_keyphrases, self.similarity_comparison_keyphrases_map = similar
         self.set_similarities()
 
     def clear_similarities(self):
@@ -156,9 +171,15 @@ class Application(Frame):
         self.similarity_text.delete(1.0, END)
 
     def set_similarities(self):
+        if self.similarity_top_keyphrases is None:
+            return
         self.clear_similarities()
         threshold = float(self.similarities_weight_entry.get())
-        similarity = DocumentKeyphrasesComparator(self.similarity_top_keyphrases, self.similarity_comparison_keyphrases_map, threshold).compare()
+        if self.minhash_var.get():
+            index = MinHashIndex(int(self.lsh_bands_entry.get()), int(self.lsh_rows_entry.get()))
+        else:
+            index = KeywordIndex()
+        similarity = DocumentKeyphrasesComparator(self.similarity_top_keyphrases, self.similarity_comparison_keyphrases_map, threshold, index=index).compare()
         content = System.get_document_similarity_string(similarity)
 
         self.similarity_text.insert(END, content)
@@ -167,6 +188,63 @@ class Application(Frame):
     def apply_similarities(self):
         self.set_similarities()
 
+    def start_job(self, job, on_done):
+        """
+        Runs job(progress) in a background worker thread so that the window stays responsive, progress reports
+        of the job are polled from the Tk loop and on_done is called with its result on the Tk thread
+        """
+        if self.progress is not None:
+            showerror("Extraction", "Another extraction is still running")
+            return
+        self.progress = ExtractionProgress()
+        self.job_results = Queue.Queue()
+        worker = threading.Thread(target=self.run_job, args=(job, self.progress, self.job_results))
+        worker.daemon = True
+        worker.start()
+        self.cancel_button.configure(state="normal")
+        self.set_progress("starting", 0, 0)
+        self.after(100, self.poll_job, on_done)
+
+    @staticmethod
+    def run_job(job, progress, job_results):
+        try:
+            job_results.put((True, job(progress)))
+        except Exception as e:
+            job_results.put((False, e))
+
+    def poll_job(self, on_done):
+        for stage, done, total in self.progress.get_updates():
+            # reports made before the job noticed the cancel would overwrite "Cancelling..."
+            if not self.progress.is_cancelled():
+                self.set_progress(stage, done, total)
+        try:
+            succeeded, result = self.job_results.get_nowait()
+        except Queue.Empty:
+            self.after(100, self.poll_job, on_done)
+            return
+        self.progress = None
+        self.cancel_button.configure(state="disabled")
+        if succeeded:
+            self.progress_label["text"] = "Finished"
+            on_done(result)
+        elif isinstance(result, ExtractionCancelledException):
+            self.progress_label["text"] = "Cancelled"
+        else:
+            self.progress_label["text"] = "Failed"
+            showerror("Extraction", "Extraction failed\n'%s'" % (str(result) or result.__class__.__name__))
+
+    def set_progress(self, stage, done, total):
+        if total:
+            self.progress_label["text"] = "{}: {} of {} documents".format(stage.capitalize(), done, total)
+        else:
+            self.progress_label["text"] = "{}...".format(stage.capitalize())
+        self.progress_bar.configure(maximum=max(total, 1), value=done)
+
+    def cancel(self):
+        if self.progress is not None:
+            self.progress.cancel()
+            self.progress_label["text"] = "Cancelling..."
+
     def __init__(self, master=None):
         Frame.__init__(self, master)
         self.master.title("Automatic Keyphrase Extraction")
@@ -237,6 +315,7 @@ class Application(Frame):
         self.dir_path = None
         self.wiki_titles = None
         self.keyphrases = None
+        self.keyphrases_contents = {}
         self.time_elapsed = None
         self.clusters = None
 
@@ -271,6 +350,24 @@ class Application(Frame):
         self.similarities_weight_entry.grid(row=8, column=0, sticky=W)
         self.similarities_weight_entry.insert(END, '0.45')
 
+        self.minhash_label = Label(similarity_page, text="Approximate (MinHash bands, rows)")
+        self.minhash_label.grid(row=7, column=1, sticky=W)
+
+        minhash_frame = Frame(similarity_page)
+        minhash_frame.grid(row=8, column=1, sticky=W)
+
+        self.minhash_var = IntVar()
+        self.minhash_checkbutton = Checkbutton(minhash_frame, variable=self.minhash_var)
+        self.minhash_checkbutton.grid(row=0, column=0, sticky=W)
+
+        self.lsh_bands_entry = Entry(minhash_frame, width=6)
+        self.lsh_bands_entry.grid(row=0, column=1, sticky=W)
+        self.lsh_bands_entry.insert(END, '32')
+
+        self.lsh_rows_entry = Entry(minhash_frame, width=6)
+        self.lsh_rows_entry.grid(row=0, column=2, sticky=W)
+        self.lsh_rows_entry.insert(END, '2')
+
         self.apply_similarities_button = Button(similarity_page, text="Apply", command=self.apply_similarities, width=20)
         self.apply_similarities_button.grid(row=8, column=2, sticky=E)
 
@@ -280,11 +377,32 @@ class Application(Frame):
         self.primary_file_path = None
         self.secondary_dir_path = None
         self.similar_articles = None
+        self.similarity_top_keyphrases = None
+        self.similarity_comparison_keyphrases_map = None
+        self.wiki_cache = WikipediaContentCache(os.path.join(DEFAULT_CACHE_DIR, 'wiki.sqlite'))
+        self.result_cache = KeyphraseResultCache(os.path.join(DEFAULT_CACHE_DIR, 'keyphrases.sqlite'))
 
         notebook.add(keyphrase_page, text="Keyphrases")
         notebook.add(similarity_page, text="Similarity")
         notebook.pack()
 
+        progress_frame = Frame(self)
+        progress_frame.grid_columnconfigure(1, weight=1)
+
+        self.progress_label = Label(progress_frame, text="Idle", width=40, anchor=W)
+        self.progress_label.grid(row=0, column=0, sticky=W)
+
+        self.progress_bar = ttk.Progressbar(progress_frame, mode="determinate")
+        self.progress_bar.grid(row=0, column=1, sticky=E+W)
+
+        self.cancel_button = Button(progress_frame, text="Cancel", command=self.cancel, width=20, state="disabled")
+        self.cancel_button.grid(row=0, column=2, sticky=E)
+
+        progress_frame.pack(fill=X)
+
+        self.progress = None
+        self.job_results = None
+
         reload(sys)
         sys.setdefaultencoding('utf-8')
 
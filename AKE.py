@@ -5,6 +5,13 @@ python AKE.py file res/python_usage.txt
 python AKE.py dir res
 python AKE.py file res/python_usage.txt --master
 python AKE.py file res/java_usage.txt --master
+python AKE.py preprocess res res.corpus
+python AKE.py corpus res.corpus
+python AKE.py corpus res.corpus --document res/python_usage.txt --master
+python AKE.py serve --port 8080
+curl -X POST --data-binary @res/python_usage.txt http://127.0.0.1:8080/extract
+python AKE.py startup-bench --max-import-seconds 0.2
+python AKE.py bench --sizes 1K,100K,10M --output bench.json
 """
 
 import argparse
@@ -12,17 +19,473 @@ import os
 import sys
 
 import math
-import wikipedia
+import heapq
+import multiprocessing
+import multiprocessing.pool
+import importlib
 import itertools
-import nltk
+import array
+import bisect
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import cPickle
+import hashlib
+import json
+import random
+import resource
 import string
-import networkx
+import struct
+import subprocess
 import operator
 import logging
-import requests
+import Queue
 import time
 import collections
-from nltk.stem import WordNetLemmatizer
+import sqlite3
+import tempfile
+import threading
+import zlib
+
+
+class LazyModule:
+    """
+    Stand-in for a heavy dependency, the module and its listed submodules are imported on first attribute
+    access, so startup pays only for the dependencies of the chosen source and stages
+    """
+    def __init__(self, module_name, submodule_names=()):
+        self.module_name = module_name
+        self.submodule_names = submodule_names
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            for submodule_name in self.submodule_names:
+                importlib.import_module(submodule_name)
+            self.module = importlib.import_module(self.module_name)
+        return getattr(self.module, attribute)
+
+
+nltk = LazyModule('nltk')
+networkx = LazyModule('networkx')
+numpy = LazyModule('numpy')
+scipy = LazyModule('scipy', ['scipy.sparse'])
+requests = LazyModule('requests', ['requests.adapters'])
+wikipedia = LazyModule('wikipedia')
+
+LAZY_MODULES = [nltk, networkx, numpy, scipy, requests, wikipedia]
+
+
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+CLUSTER_MODES = ['token', 'similarity']
+
+SIMILARITY_MODES = ['exact', 'minhash']
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ake')
+
+Token = collections.namedtuple('Token', ['word', 'lemma_id', 'tag', 'sentence'])
+
+
+class Vocabulary:
+    """
+    Process-wide table interning lemmas into integer ids. Token streams are kept as array('I') of lemma ids and
+    keyphrases as tuples of lemma ids, strings are built only when results are shown or stored; results crossing
+    process boundaries or persisted on disk are converted to words, since ids are valid only within a process
+    """
+    def __init__(self):
+        self.index = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def get_id(self, word):
+        word_id = self.index.get(word)
+        if word_id is None:
+            word_id = self.index[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def get_word(self, word_id):
+        return self.words[word_id]
+
+    def get_phrase(self, phrase_ids):
+        words = self.words
+        return ' '.join(words[word_id] for word_id in phrase_ids)
+
+    def to_words(self, keyphrases):
+        """
+        (phrase ids, weight) pairs -> (phrase words, weight) pairs
+        """
+        words = self.words
+        return [([words[word_id] for word_id in phrase_ids], weight) for phrase_ids, weight in keyphrases]
+
+    def from_words(self, keyphrases):
+        """
+        (phrase words, weight) pairs -> (phrase ids, weight) pairs
+        """
+        return [(tuple(self.get_id(word) for word in phrase_words), weight) for phrase_words, weight in keyphrases]
+
+    def clear(self):
+        """
+        forgets every lemma, ids given out before are no longer valid
+        """
+        self.index = {}
+        self.words = []
+
+
+vocabulary = Vocabulary()
+
+
+class LemmaCache:
+    """
+    Process-wide memo of WordNet lemmas keyed by lowercased surface form, bounded with LRU eviction
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.lem = None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lemmatize(self, word):
+        key = word.lower()
+        try:
+            lemma = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            lemma = self.get_lemmatizer().lemmatize(key)
+            self.misses += 1
+            self._evict(self.max_size - 1)
+        self.entries[key] = lemma
+        return lemma
+
+    def get_lemmatizer(self):
+        if self.lem is None:
+            self.lem = nltk.stem.WordNetLemmatizer()
+        return self.lem
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self._evict(max_size)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.0
+        }
+
+    def _evict(self, max_size):
+        while self.entries and len(self.entries) > max(max_size, 0):
+            self.entries.popitem(last=False)
+
+
+lemma_cache = LemmaCache()
+
+
+class SentenceCache:
+    """
+    Content-addressed memo of analyzed sentences: SHA-1 of the sentence text -> tuple of (word, tag, lemma)
+    triples, bounded with LRU eviction. Boilerplate repeated across documents is tokenized, tagged and
+    lemmatized only once; entries can be saved to and loaded from a file to be reused by later runs.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(sentence):
+        if isinstance(sentence, unicode):
+            sentence = sentence.encode('utf-8')
+        return hashlib.sha1(sentence).digest()
+
+    def get(self, key):
+        try:
+            analyzed_sentence = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = analyzed_sentence
+        return analyzed_sentence
+
+    def record_hit(self):
+        self.hits += 1
+
+    def put(self, key, analyzed_sentence):
+        self.entries.pop(key, None)
+        self._evict(self.max_size - 1)
+        if self.max_size > 0:
+            self.entries[key] = analyzed_sentence
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self._evict(max_size)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            entries = cPickle.load(f)
+        for key, analyzed_sentence in entries:
+            self.put(key, analyzed_sentence)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            cPickle.dump(self.entries.items(), f, cPickle.HIGHEST_PROTOCOL)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.0
+        }
+
+    def _evict(self, max_size):
+        while self.entries and len(self.entries) > max(max_size, 0):
+            self.entries.popitem(last=False)
+
+
+sentence_cache = SentenceCache()
+
+
+class NlpModels:
+    """
+    NLTK resources loaded lazily, once per process, and shared by every extractor
+    """
+    def __init__(self):
+        self.punctuation = set(string.punctuation)
+        self.stop_words = None
+        self.tagger = None
+
+    def get_stop_words(self):
+        if self.stop_words is None:
+            self.stop_words = set(nltk.corpus.stopwords.words('english'))
+        return self.stop_words
+
+    def get_tagger(self):
+        if self.tagger is None:
+            self.tagger = nltk.tag.PerceptronTagger()
+        return self.tagger
+
+    def load(self):
+        self.get_stop_words()
+        self.get_tagger()
+        nltk.sent_tokenize('Models are loaded.')
+        lemma_cache.get_lemmatizer().lemmatize('models')
+
+
+nlp_models = NlpModels()
+
+
+def load_nlp_models():
+    nlp_models.load()
+
+
+class Metrics:
+    """
+    Process-wide registry of counters, gauges and duration histograms, each labelled e.g. by pipeline stage,
+    provider or cache, exportable as JSON or in the Prometheus text format. Recording is a dictionary update
+    under a lock, so it is cheap enough for every chunk and every fetched page.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix='ake'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0, 0.0, [0] * (len(self.buckets) + 1)]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2][bisect.bisect_left(self.buckets, value)] += 1
+
+    def time(self, name, **labels):
+        """
+        context manager observing the duration of its block in the histogram
+        """
+        return MetricsTimer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def get_state(self):
+        """
+        plain containers that can be sent from a process pool worker and merged into the parent registry
+        """
+        with self.lock:
+            return (dict(self.counters), dict(self.gauges),
+                    dict((key, [histogram[0], histogram[1], list(histogram[2])])
+                         for key, histogram in self.histograms.iteritems()))
+
+    def merge_state(self, state):
+        counters, gauges, histograms = state
+        with self.lock:
+            for key, value in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, (count, total, bucket_counts) in histograms.iteritems():
+                histogram = self.histograms.setdefault(key, [0, 0.0, [0] * (len(self.buckets) + 1)])
+                histogram[0] += count
+                histogram[1] += total
+                histogram[2] = [a + b for a, b in itertools.izip(histogram[2], bucket_counts)]
+
+    def to_json(self):
+        counters, gauges, histograms = self.get_state()
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.iteritems())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(gauges.iteritems())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                            'buckets': dict(itertools.izip(self._get_bucket_names(),
+                                                           self._get_cumulative_counts(bucket_counts)))}
+                           for (name, labels), (count, total, bucket_counts) in sorted(histograms.iteritems())]
+        }
+
+    def to_prometheus(self):
+        counters, gauges, histograms = self.get_state()
+        lines = []
+        for metric_type, values in (('counter', counters), ('gauge', gauges)):
+            for name, series in itertools.groupby(sorted(values.iteritems()), key=lambda item: item[0][0]):
+                lines.append('# TYPE {}_{} {}'.format(self.prefix, name, metric_type))
+                for (_, labels), value in series:
+                    lines.append('{}_{}{} {}'.format(self.prefix, name, self._format_labels(labels), value))
+        for name, series in itertools.groupby(sorted(histograms.iteritems()), key=lambda item: item[0][0]):
+            lines.append('# TYPE {}_{} histogram'.format(self.prefix, name))
+            for (_, labels), (count, total, bucket_counts) in series:
+                for bucket_name, cumulative_count in itertools.izip(self._get_bucket_names(),
+                                                                    self._get_cumulative_counts(bucket_counts)):
+                    lines.append('{}_{}_bucket{} {}'.format(self.prefix, name,
+                                                            self._format_labels(labels + (('le', bucket_name),)),
+                                                            cumulative_count))
+                lines.append('{}_{}_sum{} {!r}'.format(self.prefix, name, self._format_labels(labels), total))
+                lines.append('{}_{}_count{} {}'.format(self.prefix, name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def _get_bucket_names(self):
+        return [repr(bucket) for bucket in self.buckets] + ['+Inf']
+
+    @staticmethod
+    def _get_cumulative_counts(bucket_counts):
+        cumulative_counts = []
+        total = 0
+        for count in bucket_counts:
+            total += count
+            cumulative_counts.append(total)
+        return cumulative_counts
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                                               .replace('\n', '\\n')) for name, value in labels) + '}'
+
+
+class MetricsTimer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.started_at, **self.labels)
+        return False
+
+
+metrics = Metrics()
+
+
+class ExtractionProgress:
+    """
+    Progress of an extraction running in another thread: extractors report the current stage and documents
+    done out of total, every report puts a (stage, done, total) snapshot on a queue polled by the caller.
+    Reports check for cancellation, after cancel() the next report raises ExtractionCancelledException.
+    """
+    def __init__(self):
+        self.updates = Queue.Queue()
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.stage = None
+        self.done = 0
+        self.total = 0
+
+    def report(self, stage, done=None, total=None):
+        """
+        done and total are kept from the previous report when not given
+        """
+        self.check()
+        with self.lock:
+            self.stage = stage
+            if done is not None:
+                self.done = done
+            if total is not None:
+                self.total = total
+            self.updates.put((self.stage, self.done, self.total))
+
+    def get_updates(self):
+        updates = []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except Queue.Empty:
+                return updates
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise ExtractionCancelledException()
 
 
 class System:
@@ -30,25 +493,56 @@ class System:
         self.path = configuration.path
         self.src = configuration.src
         self.master = configuration.master
+        self.ranking_engine = RANKING_ENGINES[configuration.ranking]()
+        self.workers = configuration.workers
+        self.shard_workers = configuration.shard_workers
+        self.shard_sentences = configuration.shard_sentences
+        self.fetch_concurrency = configuration.fetch_concurrency
+        self.fetch_timeout = configuration.fetch_timeout
+        self.cache_dir = configuration.cache_dir
+        self.wiki_cache_ttl = configuration.wiki_cache_ttl * 3600
+        self.wiki_cache_size = configuration.wiki_cache_size * 1024 * 1024
+        self.offline = configuration.offline
+        self.corpus_state = configuration.corpus_state
+        self.keyword_index = configuration.keyword_index
+        self.top_k = configuration.top_k
+        self.similarity_mode = configuration.similarity_mode
+        self.similarity_threshold = configuration.similarity_threshold
+        self.lsh_bands = configuration.lsh_bands
+        self.lsh_rows = configuration.lsh_rows
+        self.all_pairs = configuration.all_pairs
+        self.block_size = configuration.block_size
+        self.document = configuration.document
+        self.metrics_path = configuration.metrics
+        self.cluster_mode = configuration.cluster_mode
+        self.cluster_similarity = configuration.cluster_similarity
+        self.metrics_format = configuration.metrics_format
+        self.wiki_cache = None
+        self.result_cache = None
+        self.preprocessed_corpus = None
         self.logger = get_logger('System')
+        lemma_cache.resize(configuration.lemma_cache_size)
+        sentence_cache.resize(configuration.sentence_cache_size)
         self.logger.info('Chosen source "%s"', self.src)
         self.logger.info('Chosen path "%s"', self.path)
         self.logger.info('Master option "%s"', self.master)
+        self.logger.info('Ranking engine "%s"', configuration.ranking)
+        self.logger.info('Workers "%s"', self.workers)
 
     @staticmethod
     def get_keyphrases_string(keyphrases):
         kp_str = 'Found keyphrases:\n\n'
         for phrase in keyphrases:
-            kp_str += '{0:<40}: {1:.10f}\n'.format(phrase[0], phrase[1])
+            kp_str += '{0:<40}: {1:.10f}\n'.format(vocabulary.get_phrase(phrase[0]), phrase[1])
         return kp_str
 
     @staticmethod
     def get_clustered_keyphrases_string(clustered_keyphrases):
         clustered_result = 'Found clusters:\n\n'
         for k in sorted(clustered_keyphrases.keys(), key=lambda x: len(clustered_keyphrases[x]), reverse=True):
-            clustered_result += k + ":\n"
+            clustered_result += KeyphraseExtractor.get_cluster_name(k) + ":\n"
             for s in clustered_keyphrases[k]:
-                clustered_result += "\t" + s + "\n"
+                clustered_result += "\t" + vocabulary.get_phrase(s) + "\n"
         return clustered_result
 
     @staticmethod
@@ -60,35 +554,175 @@ class System:
             doc_string += '{0:<45}: {1:.2f}\n'.format(similarity[0], similarity[1])
         return doc_string
 
-    def run(self):
-        try:
-            main_provider = self._get_main_provider()
-            main_extractor = KeyphraseExtractor(main_provider)
-            comparison_extractor = self._get_comparison_extractor()
-
-            time_start = time.time()
-            keyphrases = main_extractor.extract_keyphrases_by_textrank()
-            top_keyphrases = main_extractor.get_top_keyphrases(keyphrases, 0.2)
-            time_end = time.time()
-            self.logger.info('Keyphrase extraction elapsed time: {:.9f} seconds'.format(time_end - time_start))
+    @staticmethod
+    def get_lemma_cache_stats_string(stats):
+        return 'Lemma cache: {size}/{max_size} entries, {hits} hits, {misses} misses, hit rate {hit_rate:.2%}'.format(
+            **stats)
 
-            self.logger.info(self.get_keyphrases_string(top_keyphrases))
-            clusters = main_extractor.clusterize(top_keyphrases)
-            self.logger.info(self.get_clustered_keyphrases_string(clusters))
+    @staticmethod
+    def get_sentence_cache_stats_string(stats):
+        return 'Sentence cache: {size}/{max_size} sentences, {hits} hits, {misses} misses, hit rate ' \
+               '{hit_rate:.2%}'.format(**stats)
 
-            if comparison_extractor is not None:
-                comparison_keyphrases_map = comparison_extractor.extract_keyphrases_map_by_textrank()
-                similarity = DocumentKeyphrasesComparator(top_keyphrases, comparison_keyphrases_map).compare()
-                self.logger.info(self.get_document_similarity_string(similarity))
+    def run(self):
+        try:
+            self.wiki_cache = self._get_wiki_cache()
+            self.result_cache = self._get_result_cache()
+            self._load_sentence_cache()
+            if self.all_pairs is not None:
+                self._write_all_pairs_similarity()
+            else:
+                self._extract()
+
+            self.logger.info(self.get_lemma_cache_stats_string(lemma_cache.get_stats()))
+            self.logger.info(self.get_sentence_cache_stats_string(sentence_cache.get_stats()))
+            self._save_sentence_cache()
+
+            if self.metrics_path is not None:
+                write_metrics(self.metrics_path, self.metrics_format)
+                self.logger.info('Wrote metrics to "{}"'.format(self.metrics_path))
 
         except ConfigurationException:
             self.logger.error('Configuration error, could not start keyphrase extraction')
         except ContentProviderException:
             self.logger.error('Failed to retrieve content for keyphrase extraction')
 
+    def _extract(self):
+        main_extractor = self._get_main_extractor()
+        comparison_extractor = self._get_comparison_extractor()
+
+        time_start = time.time()
+        keyphrases = main_extractor.extract_keyphrases_by_textrank()
+        top_keyphrases = main_extractor.get_top_keyphrases(keyphrases, 0.2)
+        time_end = time.time()
+        self.logger.info('Keyphrase extraction elapsed time: {:.9f} seconds'.format(time_end - time_start))
+
+        self.logger.info(self.get_keyphrases_string(top_keyphrases))
+        clusters = main_extractor.clusterize(top_keyphrases, self.cluster_mode, self.cluster_similarity)
+        self.logger.info(self.get_clustered_keyphrases_string(clusters))
+
+        if comparison_extractor is not None:
+            comparison_keyphrases_map = comparison_extractor.extract_keyphrases_map_by_textrank()
+            similarity = self._compare(top_keyphrases, comparison_keyphrases_map)
+            self.logger.info(self.get_document_similarity_string(similarity))
+
+    def _write_all_pairs_similarity(self):
+        extractor = self._get_all_documents_extractor()
+        time_start = time.time()
+        keyphrases_map = extractor.extract_keyphrases_map_by_textrank()
+        self.logger.info('Extracted keyphrases of {} documents in {:.3f} seconds'.format(len(keyphrases_map),
+                                                                                        time.time() - time_start))
+        time_start = time.time()
+        documents_count = DocumentSimilarityMatrix(keyphrases_map).write_neighbours(
+            self.all_pairs, self.top_k, self.similarity_threshold, self.block_size)
+        self.logger.info('Wrote neighbours of {} documents to "{}" in {:.3f} seconds'.format(
+            documents_count, self.all_pairs, time.time() - time_start))
+
+    def _get_all_documents_extractor(self):
+        if self.master:
+            self.logger.error('all pairs option cannot be combined with master option!')
+            raise ConfigurationException()
+        if self.src == 'dir':
+            paths = DirectoryContentLister(self.path).get_content_list()
+            file_providers = [FileContentProvider(path) for path in paths]
+            return MultipleProvidersKeyphraseExtractor(file_providers, self.ranking_engine, self.workers,
+                                                       result_cache=self.result_cache)
+        if self.src == 'corpus':
+            return self._get_preprocessed_corpus_extractor(self._get_master_document_names())
+        self.logger.error('all pairs option is supported only for dir and corpus sources!')
+        raise ConfigurationException()
+
+    def _compare(self, top_keyphrases, comparison_keyphrases_map):
+        if self.keyword_index is not None:
+            return self._compare_with_persistent_index(top_keyphrases, comparison_keyphrases_map)
+        index = get_keyword_index(self.similarity_mode, self.lsh_bands, self.lsh_rows)
+        if self.similarity_mode == 'minhash':
+            # documents with as many keywords as the master scoring t have Jaccard similarity t / (2 - t)
+            recall = index.get_candidate_probability(self.similarity_threshold / (2 - self.similarity_threshold))
+            self.logger.info('MinHash index of {} bands of {} rows, documents scoring {} are found with probability '
+                             '{:.2%}'.format(self.lsh_bands, self.lsh_rows, self.similarity_threshold, recall))
+        return DocumentKeyphrasesComparator(top_keyphrases, comparison_keyphrases_map, self.similarity_threshold,
+                                            self.top_k, index).compare()
+
+    def _compare_with_persistent_index(self, top_keyphrases, comparison_keyphrases_map):
+        """
+        the index is first synchronized with the compared documents: changed ones are indexed again, the ones
+        deleted or no longer compared are dropped
+        """
+        titles = dict((PersistentKeywordIndex._to_text(self._get_index_key(title)), title)
+                      for title in comparison_keyphrases_map)
+        index = PersistentKeywordIndex(self.keyword_index)
+        changed_count, removed_count = index.synchronize(dict(
+            (key, DocumentKeyphrasesComparator._extract_words(comparison_keyphrases_map[title]))
+            for key, title in titles.iteritems()))
+        self.logger.info('Keyword index "{}" of {} documents updated: {} documents added or changed, {} removed'.format(
+            self.keyword_index, index.get_documents_count(), changed_count, removed_count))
+        with metrics.time('stage_duration_seconds', stage='compare'):
+            similarity = index.query(DocumentKeyphrasesComparator._extract_words(top_keyphrases),
+                                     self.similarity_threshold, self.top_k)
+        return [(titles[key], score) for key, score in similarity]
+
+    def _get_index_key(self, title):
+        """
+        files are indexed by their normalized absolute paths, so the same file is one document however the
+        path is spelled
+        """
+        if self.src == 'file':
+            return os.path.normcase(os.path.abspath(title))
+        return title
+
+    def _get_wiki_cache(self):
+        if self.cache_dir is None:
+            if self.offline:
+                self.logger.error('offline option requires cache directory!')
+                raise ConfigurationException()
+            return None
+        return WikipediaContentCache(os.path.join(self.cache_dir, 'wiki.sqlite'), self.wiki_cache_ttl,
+                                     self.wiki_cache_size, self.offline)
+
+    def _get_result_cache(self):
+        if self.cache_dir is None:
+            return None
+        return KeyphraseResultCache(os.path.join(self.cache_dir, 'keyphrases.sqlite'))
+
+    def _load_sentence_cache(self):
+        if self.cache_dir is None:
+            return
+        path = os.path.join(self.cache_dir, 'sentences.pickle')
+        if os.path.isfile(path):
+            sentence_cache.load(path)
+            self.logger.info('Loaded {} sentences from "{}"'.format(len(sentence_cache.entries), path))
+
+    def _save_sentence_cache(self):
+        if self.cache_dir is None or not sentence_cache.max_size:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        sentence_cache.save(os.path.join(self.cache_dir, 'sentences.pickle'))
+
+    def _get_main_extractor(self):
+        if self.src == 'corpus':
+            return self._get_preprocessed_corpus_extractor(self._get_master_document_names())
+        if self.document is not None:
+            self.logger.error('document option is supported only for corpus source!')
+            raise ConfigurationException()
+        if self.corpus_state is None and self.shard_workers > 1:
+            return ShardedKeyphraseExtractor(self._get_main_provider(), self.ranking_engine, self.result_cache,
+                                             self.shard_workers, self.shard_sentences)
+        if self.corpus_state is None:
+            return KeyphraseExtractor(self._get_main_provider(), self.ranking_engine, self.result_cache)
+        if self.src != 'dir':
+            self.logger.error('corpus state option is supported only for dir source!')
+            raise ConfigurationException()
+        if not isinstance(self.ranking_engine, SparseRankingEngine):
+            # warm-started ranking of the corpus graph is implemented by the sparse engine only
+            self.logger.error('corpus state option is supported only for sparse ranking!')
+            raise ConfigurationException()
+        return IncrementalCorpusExtractor(self.path, self.corpus_state, self.ranking_engine)
+
     def _get_main_provider(self):
         if self.src == 'wiki':
-            return WikipediaContentProvider(self.path)
+            return WikipediaContentProvider(self.path, self.wiki_cache)
         elif self.src == 'dir':
             return DirectoryContentProvider(self.path)
         elif self.src == 'file':
@@ -97,12 +731,20 @@ class System:
             raise ConfigurationException()
 
     def _get_comparison_extractor(self):
+        if self.master and self.keyword_index is not None and self.similarity_mode != 'exact':
+            self.logger.error('keyword index option is supported only for exact similarity mode!')
+            raise ConfigurationException()
         if self.master:
             if self.src == 'dir':
                 self.logger.error('dir source is not supported for master option!')
                 raise ConfigurationException()
             elif self.src == 'file':
                 return self._get_comparison_files_extractor()
+            elif self.src == 'corpus':
+                master_document_names = self._get_master_document_names()
+                return self._get_preprocessed_corpus_extractor(
+                    [name for name in self._get_preprocessed_corpus().get_document_names()
+                     if name not in master_document_names])
             elif self.src == 'wiki':
                 try:
                     return self._get_linked_wiki_pages_extractor()
@@ -112,6 +754,25 @@ class System:
         else:
             return None
 
+    def _get_preprocessed_corpus_extractor(self, document_names):
+        return PreprocessedCorpusExtractor(self._get_preprocessed_corpus(), document_names, self.ranking_engine)
+
+    def _get_preprocessed_corpus(self):
+        if self.preprocessed_corpus is None:
+            self.preprocessed_corpus = PreprocessedCorpus(self.path).open()
+        return self.preprocessed_corpus
+
+    def _get_master_document_names(self):
+        if self.document is None:
+            if self.master:
+                self.logger.error('master option of corpus source requires document option!')
+                raise ConfigurationException()
+            return None
+        if self.document not in self._get_preprocessed_corpus().document_index:
+            self.logger.error('Document "{}" is not in the preprocessed corpus'.format(self.document))
+            raise ConfigurationException()
+        return [self.document]
+
     def _get_comparison_files_extractor(self):
         master_dir_path = os.path.dirname(self.path)
         excluded_path = os.path.basename(self.path)
@@ -123,45 +784,309 @@ class System:
         for path in comparison_file_paths:
             file_providers.append(FileContentProvider(path))
         self.logger.info('Comparison file providers ready')
-        return MultipleProvidersKeyphraseExtractor(file_providers)
+        return MultipleProvidersKeyphraseExtractor(file_providers, self.ranking_engine, self.workers,
+                                                   result_cache=self.result_cache)
 
     def _get_linked_wiki_pages_extractor(self):
         self.logger.info('Finding linked to master wiki pages...')
-        page = WikipediaPageFinder(self.path).get_wikipedia_page()
-        links = page.links
+        links = self._get_linked_wiki_titles()
         self.logger.info('Found {} linked wiki pages'.format(len(links)))
+        self.logger.info('Fetching linked wiki pages...')
+        fetcher = WikipediaPagesFetcher(self.fetch_concurrency, self.fetch_timeout, cache=self.wiki_cache)
+        contents = fetcher.fetch_all(links)
+        self.logger.info('Fetched {} of {} linked wiki pages'.format(len(contents), len(links)))
         self.logger.info('Preparing linked wiki page providers...')
         link_page_providers = []
         for link in links:
-            link_page_providers.append(WikipediaContentProvider(link))
+            if link in contents:
+                link_page_providers.append(TextContentProvider(link, contents[link]))
         self.logger.info('Linked wiki page providers ready')
-        return MultipleProvidersKeyphraseExtractor(link_page_providers)
+        return MultipleProvidersKeyphraseExtractor(link_page_providers, self.ranking_engine, self.workers,
+                                                   result_cache=self.result_cache)
+
+    def _get_linked_wiki_titles(self):
+        if self.wiki_cache is not None:
+            links = self.wiki_cache.get_links(self.path)
+            if links is not None:
+                return links
+            if self.wiki_cache.offline:
+                self.logger.error('Links of page "{}" are not cached'.format(self.path))
+                raise WikipediaException()
+        page = WikipediaPageFinder(self.path).get_wikipedia_page()
+        if self.wiki_cache is not None:
+            self.wiki_cache.put(self.path, page.content, page.revision_id, page.links)
+        return page.links
+
+
+class RankedKeyphrases(list):
+    """
+    Extraction result, (phrase ids, weight) pairs sorted by weight, with cumulative weights computed once.
+    The shortest prefix reaching a share of the total weight is found by binary search, so selecting top
+    keyphrases for another threshold costs O(log n).
+    """
+    def __init__(self, keyphrases=()):
+        list.__init__(self, keyphrases)
+        self.cumulative_weights = []
+        weights_sum = 0
+        for _, weight in self:
+            weights_sum += weight
+            self.cumulative_weights.append(weights_sum)
+
+    def get_top_count(self, top_keyphrases):
+        """
+        returns the number of keyphrases preceding the one at which top_keyphrases share of the total weight
+        is reached
+        """
+        if not self.cumulative_weights:
+            return 0
+        return bisect.bisect_left(self.cumulative_weights, top_keyphrases * self.cumulative_weights[-1])
+
+    def get_top(self, top_keyphrases):
+        return self[:self.get_top_count(top_keyphrases)]
+
+
+class WordsSpool:
+    """
+    Word streams of the chunks, kept for the keyphrase merging pass after ranking. Streams are held in memory
+    up to max_memory_words lemma ids, beyond that all of them are spilled to a temporary file and read back
+    one by one, so memory is bounded by the chunk size instead of the size of the whole input.
+    """
+    max_memory_words = 1 << 22
+
+    def __init__(self):
+        self.streams = []
+        self.memory_words = 0
+        self.file = None
+        self.lengths = []
+
+    def append(self, words):
+        if self.file is None and self.memory_words + len(words) <= self.max_memory_words:
+            self.streams.append(words)
+            self.memory_words += len(words)
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+            for spilled_words in self.streams:
+                self._spill(spilled_words)
+            self.streams = []
+            self.memory_words = 0
+        self._spill(words)
+
+    def __iter__(self):
+        for words in self.streams:
+            yield words
+        if self.file is not None:
+            self.file.seek(0)
+            for length in self.lengths:
+                yield numpy.fromfile(self.file, numpy.uint32, length)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _spill(self, words):
+        numpy.frombuffer(words, dtype=numpy.uint32).tofile(self.file)
+        self.lengths.append(len(words))
 
 
 class KeyphraseExtractor:
-    def __init__(self, provider):
+    def __init__(self, provider, ranking_engine=None, result_cache=None, progress=None):
         self.top_keywords_rank = 0.6
+        self.good_tags = {'JJ', 'JJR', 'JJS', 'NN', 'NNP', 'NNS', 'NNPS'}
+        self.keyphrase_window = 5
         self.logger = get_logger('KeyphraseExtractor')
-        self.lem = WordNetLemmatizer()
+        self.ranking_engine = ranking_engine or SparseRankingEngine()
+        self.result_cache = result_cache
         self.provider = provider
-        self.text = ''
+        self.progress = progress
 
     def extract_keyphrases_by_textrank(self):
-        self.logger.info('Getting text content from provider entitled "{}"'.format(self.provider.get_title()))
-        self.text = self.provider.get_content()
+        self.logger.info('Getting text content from provider entitled "%s"', self.provider.get_title())
+        self._report_progress('reading', 0, 1)
+        metrics.increment('documents_total', provider=self.provider.__class__.__name__)
+        get_chunks = self._get_chunks_source()
+        if self.result_cache is None:
+            return self._extract_keyphrases_from_chunks(get_chunks())
+        key = self.result_cache.get_key(get_chunks(), self.get_parameters())
+        normalized_result = self.result_cache.get(key)
+        if normalized_result is not None:
+            self.logger.info('Got keyphrases from result cache')
+            self._report_progress('done', 1)
+            return normalized_result
+        normalized_result = self._extract_keyphrases_from_chunks(get_chunks())
+        self.result_cache.put(key, normalized_result)
+        return normalized_result
+
+    def _report_progress(self, stage, done=None, total=None):
+        if self.progress is not None:
+            self.progress.report(stage, done, total)
+
+    def _get_chunks_source(self):
+        """
+        returns a callable producing the provider's text chunks, streaming providers are read lazily again
+        on every call while the content of the other ones is retrieved only once
+        """
+        if self.provider.streaming:
+            return self.provider.iter_content
+        with metrics.time('provider_content_seconds', provider=self.provider.__class__.__name__):
+            content = [self.provider.get_content()]
+        return lambda: content
+
+    def get_parameters(self):
+        """
+        everything besides the text that the extracted keyphrases depend on
+        """
+        return {
+            'top_keywords_rank': self.top_keywords_rank,
+            'good_tags': sorted(self.good_tags),
+            'keyphrase_window': self.keyphrase_window,
+            'ranking_engine': self.ranking_engine.get_parameters()
+        }
+
+    def _extract_keyphrases_from_chunks(self, chunks):
+        keyphrases = self._extract_keyphrases_from_streams(self._analyze_chunks(chunks))
+        self._report_progress('done', 1)
+        return keyphrases
+
+    def _analyze_chunks(self, chunks):
+        for chunk in chunks:
+            self._report_progress('analyzing')
+            tokens = self._analyze_text(chunk)
+            yield self._get_words(tokens), self._get_candidate_words(tokens, self.good_tags)
+
+    def _extract_keyphrases_from_streams(self, streams):
+        """
+        streams are (words, candidates) lemma id arrays of independent chunks, consumed one by one, only the
+        words are kept for keyphrase merging, in a spool, while candidates are fed straight into the
+        co-occurrence graph; neighbourhood does not cross chunks
+        """
         self.logger.info('Starting keyphrase extraction...')
-        words = self._tokenize_text()
-        candidates = self._extract_candidate_words()
-        graph = self._build_graph_from_candidates(candidates)
-        word_ranks = self._build_word_pagerank_ranks_from_graph(graph)
+        graph = self.ranking_engine.create_graph()
+        chunks_words = WordsSpool()
+        try:
+            for words, candidates in streams:
+                chunks_words.append(words)
+                with metrics.time('stage_duration_seconds', stage='graph_build'):
+                    self.ranking_engine.add_candidates(graph, candidates)
+            return self._extract_keyphrases_from_graph(graph, chunks_words)
+        finally:
+            chunks_words.close()
+
+    def _extract_keyphrases_from_graph(self, graph, chunks_words):
+        nodes_count, edges_count = self.ranking_engine.get_graph_size(graph)
+        metrics.increment('graph_nodes_total', nodes_count)
+        metrics.increment('graph_edges_total', edges_count)
+        self._report_progress('ranking')
+        with metrics.time('stage_duration_seconds', stage='pagerank'):
+            ranks = self.ranking_engine.rank_graph(graph)
+            word_ranks = self._select_top_word_ranks(ranks)
         keywords = set(word_ranks.keys())
-        keyphrases = self._merge_keywords_into_keyphrases(keywords, word_ranks, words)
-        result = sorted(keyphrases.items(), key=operator.itemgetter(1), reverse=True)
-        normalized_result = self._normalize_weights(result)
+        # keyphrases of equal weight keep the order of their first occurrence
+        keyphrases = collections.OrderedDict()
+        with metrics.time('stage_duration_seconds', stage='merge'):
+            for words in chunks_words:
+                self._merge_keywords_into_keyphrases(keywords, word_ranks, words, self.keyphrase_window, keyphrases)
+            result = sorted(keyphrases.items(), key=operator.itemgetter(1), reverse=True)
+        with metrics.time('stage_duration_seconds', stage='normalize'):
+            normalized_result = RankedKeyphrases(self._normalize_weights(result) if result else result)
+        metrics.increment('keywords_total', len(keywords))
+        metrics.increment('keyphrases_total', len(normalized_result))
         self.logger.info('Finished keyphrase extraction')
         return normalized_result
 
-    def _extract_candidate_words(self, good_tags={'JJ', 'JJR', 'JJS', 'NN', 'NNP', 'NNS', 'NNPS'}):
+    def _analyze_text(self, text):
+        """
+        Single analysis pass over the text: sentence split, word tokenization, POS tagging and lemmatization
+        are each done exactly once, producing a stream of Token(word, lemma_id, tag, sentence) tuples
+        """
+        return self._get_tokens(self._analyze_sentences(self._split_sentences(text)))
+
+    @staticmethod
+    def _split_sentences(text):
+        with metrics.time('stage_duration_seconds', stage='tokenize'):
+            return nltk.sent_tokenize(text)
+
+    @staticmethod
+    def _analyze_sentences(sentences):
+        """
+        returns (word, tag, lemma) triples of every sentence, sentences found in the sentence cache are not
+        analyzed again, the others are tokenized, tagged together in one tagger call and cached; a sentence
+        repeated among the missing ones is analyzed once
+        """
+        analyzed_sentences, missing = KeyphraseExtractor._get_cached_sentences(sentences)
+        if missing:
+            tokenized_sentences = KeyphraseExtractor._tokenize_words(missing)
+            tagged_sentences = KeyphraseExtractor._tag_sentences(tokenized_sentences)
+            KeyphraseExtractor._cache_sentences(analyzed_sentences, missing,
+                                                KeyphraseExtractor._lemmatize_sentences(tagged_sentences))
+        return analyzed_sentences
+
+    @staticmethod
+    def _get_cached_sentences(sentences):
+        """
+        returns analyzed sentences, None for the ones missing in the sentence cache, and the missing ones
+        """
+        metrics.increment('sentences_total', len(sentences))
+        analyzed_sentences = []
+        # key -> (sentence, indices of its occurrences), in order of first occurrence
+        missing = collections.OrderedDict()
+        for sentence in sentences:
+            key = sentence_cache.get_key(sentence)
+            if key in missing:
+                # repeat of a sentence analyzed below, served as a hit
+                sentence_cache.record_hit()
+                analyzed_sentence = None
+            else:
+                analyzed_sentence = sentence_cache.get(key)
+            if analyzed_sentence is None:
+                missing.setdefault(key, (sentence, []))[1].append(len(analyzed_sentences))
+            analyzed_sentences.append(analyzed_sentence)
+        metrics.increment('sentence_cache_hits_total', len(sentences) - len(missing))
+        metrics.increment('sentence_cache_misses_total', len(missing))
+        return analyzed_sentences, missing
+
+    @staticmethod
+    def _tokenize_words(missing):
+        with metrics.time('stage_duration_seconds', stage='tokenize'):
+            return [nltk.word_tokenize(sentence) for sentence, _ in missing.itervalues()]
+
+    @staticmethod
+    def _cache_sentences(analyzed_sentences, missing, missing_analyzed_sentences):
+        """
+        caches the analyzed missing sentences and puts them in place of every occurrence
+        """
+        for (key, (_, indices)), analyzed_sentence in itertools.izip(missing.iteritems(), missing_analyzed_sentences):
+            sentence_cache.put(key, analyzed_sentence)
+            for index in indices:
+                analyzed_sentences[index] = analyzed_sentence
+
+    @staticmethod
+    def _tag_sentences(sentences):
+        with metrics.time('stage_duration_seconds', stage='tag'):
+            return nlp_models.get_tagger().tag_sents(sentences)
+
+    @staticmethod
+    def _lemmatize_sentences(tagged_sentences):
+        with metrics.time('stage_duration_seconds', stage='lemmatize'):
+            return [tuple((word, tag, KeyphraseExtractor._normalize_word(word)) for word, tag in tagged_sentence)
+                    for tagged_sentence in tagged_sentences]
+
+    @staticmethod
+    def _get_tokens(analyzed_sentences):
+        tokens = []
+        for sentence_index, analyzed_sentence in enumerate(analyzed_sentences):
+            for word, tag, lemma in analyzed_sentence:
+                tokens.append(Token(word, vocabulary.get_id(lemma), tag, sentence_index))
+        metrics.increment('tokens_total', len(tokens))
+        return tokens
+
+    @staticmethod
+    def _get_words(tokens):
+        return array.array('I', [token.lemma_id for token in tokens])
+
+    @staticmethod
+    def _get_candidate_words(tokens, good_tags={'JJ', 'JJR', 'JJS', 'NN', 'NNP', 'NNS', 'NNPS'}):
         """
         https://www.ling.upenn.edu/courses/Fall_2003/ling001/penn_treebank_pos.html
         JJ - Adjective
@@ -173,81 +1098,100 @@ class KeyphraseExtractor:
         NNPS - Proper noun, plural
         """
         # exclude candidates that are stop words or entirely punctuation
-        punctuation = set(string.punctuation)
-        stop_words = set(nltk.corpus.stopwords.words('english'))
-        # tokenize and Part Of Speech-tag words
-        tagged_sentences = []
-        for sentence in nltk.sent_tokenize(self.text):
-            tagged_sentences.append(nltk.word_tokenize(sentence))
-        tagged_words = itertools.chain.from_iterable(nltk.pos_tag_sents(tagged_sentences))
-        # filter on certain POS tags and lowercase all words
-        candidates = []
-        for word, tag in tagged_words:
-            if (tag in good_tags) and (word.lower() not in stop_words) and not all(
-                            char in punctuation for char in word):
-                candidates.append(self._normalize_word(word))
+        punctuation = nlp_models.punctuation
+        stop_words = nlp_models.get_stop_words()
+        # filter on certain POS tags, candidates are ids of lemmatized and lowercased words
+        candidates = array.array('I')
+        with metrics.time('stage_duration_seconds', stage='candidate_filter'):
+            for token in tokens:
+                if (token.tag in good_tags) and (token.word.lower() not in stop_words) and not all(
+                                char in punctuation for char in token.word):
+                    candidates.append(token.lemma_id)
+        metrics.increment('candidates_total', len(candidates))
         return candidates
 
     @staticmethod
-    def _to_pairs(iterable):
-        """ Converts iterable i to pairs:
-        i -> (i0,i1), (i1,i2), (i2, i3), ..."""
-        a, b = itertools.tee(iterable)
-        next(b, None)
-        return itertools.izip(a, b)
+    def _normalize_word(word):
+        return lemma_cache.lemmatize(word)
 
-    def _build_graph_from_candidates(self, candidates):
+    def _select_top_word_ranks(self, ranks):
         """
-        each node is a unique candidate
+        words of the highest ranks until their sum reaches top_keywords_rank. Instead of sorting all ranks,
+        the top count ranks, with every rank tied to the lowest of them, are selected with NumPy partitioning
+        and only they are sorted, count grows until the selected ranks reach the sum; ties keep the order of
+        ranks like a stable sort
         """
-        graph = networkx.Graph()
-        graph.add_nodes_from(set(candidates))
-        # iterate over word-pairs, add unweighted edges into graph
-        for w1, w2 in self._to_pairs(candidates):
-            if w2:
-                graph.add_edge(*sorted([w1, w2]))
-        return graph
-
-    def _tokenize_text(self):
-        words = []
-        for sent in nltk.sent_tokenize(self.text):
-            for word in nltk.word_tokenize(sent):
-                words.append(self._normalize_word(word))
-        return words
-
-    def _normalize_word(self, word):
-        return self.lem.lemmatize(word.lower())
-
-    def _build_word_pagerank_ranks_from_graph(self, graph):
-        word_ranks = {}
-        ranks = networkx.pagerank(graph)
-        sorted_top_ranks = sorted(ranks.items(), key=operator.itemgetter(1), reverse=True)
-        total_rank = 0
-        for word_rank in sorted_top_ranks:
-            word_ranks[word_rank[0]] = word_rank[1]
-            total_rank += word_rank[1]
-            if total_rank >= self.top_keywords_rank:
-                break
+        if not ranks:
+            return {}
+        words = ranks.keys()
+        values = numpy.fromiter(ranks.itervalues(), dtype=numpy.float64, count=len(ranks))
+        count = min(64, len(values))
+        while True:
+            lowest = -numpy.partition(-values, count - 1)[count - 1]
+            selected = numpy.flatnonzero(values >= lowest)
+            selected = selected[numpy.lexsort((selected, -values[selected]))]
+            end = numpy.searchsorted(numpy.cumsum(values[selected]), self.top_keywords_rank)
+            if end < len(selected) or count == len(values):
+                selected = selected[:end + 1].tolist()
+                return dict(itertools.izip([words[i] for i in selected], values[selected].tolist()))
+            count = min(count * 4, len(values))
 
-        return word_ranks
-
-    @staticmethod
-    def _merge_keywords_into_keyphrases(keywords, word_ranks, words):
-        keyphrases = {}
-        for i, word in enumerate(words):
-            if word in keywords:
-                keyphrase_words = []
-                for w in words[i:i + 5]:
-                    if w in keywords and w not in keyphrase_words:
-                        keyphrase_words.append(w)
-                    else:
-                        break
-                keyphrase = ' '.join(keyphrase_words)
-                if keyphrase not in keyphrases:
-                    avg_pagerank = sum(word_ranks[w] for w in keyphrase_words) / float(len(keyphrase_words))
-                    keyphrases[keyphrase] = avg_pagerank
+    @staticmethod
+    def _merge_keywords_into_keyphrases(keywords, word_ranks, words, window=5, keyphrases=None):
+        """
+        A keyphrase starts at every keyword occurrence and spans at most window words, it stops at the first
+        word that is not a keyword or that repeats in the phrase. Words are a buffer of lemma ids, they are
+        mapped to positions in the sorted keyword ids (-1 for other words), phrase lengths are computed in bulk
+        with NumPy and phrases are deduplicated as rows. Keyphrases are tuples of lemma ids added in the order
+        of their first occurrence, which sorting by weight keeps for keyphrases of equal weight.
+        """
+        if keyphrases is None:
+            keyphrases = collections.OrderedDict()
+        if not len(words) or not keywords:
+            return keyphrases
+        keyword_ids = numpy.array(sorted(keywords), dtype=numpy.int64)
+        word_ids = numpy.frombuffer(words, dtype=numpy.uint32).astype(numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(keyword_ids, word_ids), len(keyword_ids) - 1)
+        ids = numpy.where(keyword_ids[positions] == word_ids, positions, -1)
+        starts = numpy.flatnonzero(ids >= 0)
+        if not len(starts):
+            return keyphrases
+        # every keyword run ends at the next non-keyword word or at the end of the words
+        run_ends = numpy.append(numpy.flatnonzero(ids < 0), len(ids))
+        lengths = numpy.minimum(run_ends[numpy.searchsorted(run_ends, starts)], starts + window) - starts
+        padded_ids = numpy.append(ids, numpy.repeat(numpy.int64(-1), window))
+        windows = numpy.lib.stride_tricks.as_strided(padded_ids, shape=(len(ids), window),
+                                                     strides=(padded_ids.strides[0],) * 2)[starts]
+        for k in xrange(1, window):
+            repeated = (windows[:, :k] == windows[:, k:k + 1]).any(axis=1)
+            lengths = numpy.where(repeated, numpy.minimum(lengths, k), lengths)
+        phrases = numpy.where(numpy.arange(window) < lengths[:, numpy.newaxis], windows, -1)
+        first_occurrences = KeyphraseExtractor._get_first_unique_rows(phrases, len(keyword_ids))
+        keyword_ids = keyword_ids.tolist()
+        for row in phrases[first_occurrences].tolist():
+            keyphrase = tuple(keyword_ids[position] for position in row if position >= 0)
+            if keyphrase not in keyphrases:
+                avg_pagerank = sum(word_ranks[w] for w in keyphrase) / float(len(keyphrase))
+                keyphrases[keyphrase] = avg_pagerank
         return keyphrases
 
+    @staticmethod
+    def _get_first_unique_rows(rows, max_value):
+        """
+        indices of the first occurrence of every distinct row, in order; rows of values in [-1, max_value)
+        are packed into single int64 keys when they fit
+        """
+        bits = max(int(max_value).bit_length(), 1)
+        if bits * rows.shape[1] > 62:
+            _, first_occurrences = numpy.unique(rows, axis=0, return_index=True)
+            return numpy.sort(first_occurrences)
+        keys = ((rows + 1) << (bits * numpy.arange(rows.shape[1]))).sum(axis=1)
+        order = numpy.argsort(keys)
+        sorted_keys = keys[order]
+        group_starts = numpy.flatnonzero(numpy.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        first_occurrences = numpy.minimum.reduceat(order, group_starts)
+        return numpy.sort(first_occurrences)
+
     @staticmethod
     def _normalize_weights(keyphrases):
         total_sum = 0
@@ -262,59 +1206,940 @@ class KeyphraseExtractor:
 
     @staticmethod
     def get_top_keyphrases(phrases, top_keyphrases):
-        total_sum = 0
-        for phrase in phrases:
-            total_sum += phrase[1]
+        if not isinstance(phrases, RankedKeyphrases):
+            phrases = RankedKeyphrases(phrases)
+        return phrases.get_top(top_keyphrases)
 
-        threshold_sum = top_keyphrases * total_sum
-        result = []
-        sub_sum = 0
-        for phrase in phrases:
-            sub_sum += phrase[1]
-            if sub_sum >= threshold_sum:
-                break
-            result.append(phrase)
+    @staticmethod
+    def clusterize(keyphrases, mode='token', similarity=0.5):
+        """
+        token mode: lemma id -> phrases containing that lemma as a token, for every lemma longer than one
+        character; similarity mode: first phrase of a cluster -> phrases of the cluster, see
+        _clusterize_by_similarity. Phrases keep the order of the keyphrases in both modes.
+        """
+        with metrics.time('stage_duration_seconds', stage='clusterize'):
+            if mode == 'similarity':
+                return KeyphraseExtractor._clusterize_by_similarity(keyphrases, similarity)
+            return KeyphraseExtractor._clusterize_by_token(keyphrases)
+
+    @staticmethod
+    def get_cluster_name(cluster):
+        if isinstance(cluster, tuple):
+            return vocabulary.get_phrase(cluster)
+        return vocabulary.get_word(cluster)
 
+    @staticmethod
+    def _clusterize_by_token(keyphrases):
+        """
+        the result is the inverted index from lemma to phrases, built in a single pass over phrase tokens
+        """
+        result = {}
+        for phrase, _ in keyphrases:
+            for word_id in phrase:
+                result.setdefault(word_id, []).append(phrase)
+        for word_id in [word_id for word_id in result if len(vocabulary.get_word(word_id)) <= 1]:
+            del result[word_id]
         return result
 
     @staticmethod
-    def clusterize(keyphrases):
-        phrases = [p[0] for p in keyphrases]
-        flat = ' '.join(phrases).split()
-        counter = collections.Counter(flat)
-        clusters = [c for c in counter.keys() if len(c) > 1 and counter[c] >= 1]
+    def _clusterize_by_similarity(keyphrases, similarity):
+        """
+        Single-linkage agglomerative clustering, phrases are linked when the Jaccard similarity of their lemma
+        sets is at least the given similarity. For sets of given sizes the similarity only grows with the
+        overlap, so two phrases are linked exactly when they share a subset of the minimal overlap for their
+        sizes. Every phrase is indexed under each subset of its lemmas together with its size and looks up the
+        buckets of its own subsets of the minimal overlaps; all phrases of a matching bucket are linked to it,
+        so the bucket is then collapsed to a single phrase. Phrases are at most keyphrase window lemmas long,
+        which keeps the number of subsets small and the clustering linear in the number of phrases.
+        """
+        phrases = [phrase for phrase, _ in keyphrases]
+        parents = range(len(phrases))
+
+        def find(index):
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        max_size = max([len(set(phrase)) for phrase in phrases] or [0])
+        buckets = {}
+        for index, phrase in enumerate(phrases):
+            lemmas = tuple(sorted(set(phrase)))
+            size = len(lemmas)
+            for other_size in xrange(1, max_size + 1):
+                overlap = max(int(math.ceil(similarity * (size + other_size) / (1.0 + similarity) - 1e-9)), 1)
+                if overlap > min(size, other_size):
+                    continue
+                for subset in itertools.combinations(lemmas, overlap):
+                    bucket = buckets.get((subset, other_size))
+                    if bucket:
+                        for other_index in bucket:
+                            parents[find(other_index)] = find(index)
+                        del bucket[1:]
+            for subset_size in xrange(1, size + 1):
+                for subset in itertools.combinations(lemmas, subset_size):
+                    buckets.setdefault((subset, size), []).append(index)
+
+        clusters = collections.OrderedDict()
+        for index, phrase in enumerate(phrases):
+            clusters.setdefault(find(index), []).append(phrase)
+        return dict((cluster_phrases[0], cluster_phrases) for cluster_phrases in clusters.itervalues())
+
+
+class NetworkxRankingEngine:
+    """
+    Reference TextRank backend, ranks a networkx.Graph of the candidates with networkx.pagerank
+    """
+    def __init__(self, damping=0.85, tolerance=1.0e-6, max_iterations=100):
+        self.damping = damping
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def get_parameters(self):
+        return {'engine': 'networkx', 'damping': self.damping, 'tolerance': self.tolerance,
+                'max_iterations': self.max_iterations}
+
+    def rank(self, candidates):
+        graph = self.create_graph()
+        self.add_candidates(graph, candidates)
+        return self.rank_graph(graph)
 
-        result = {}
+    @staticmethod
+    def create_graph():
+        return networkx.Graph()
 
-        for cluster_name in clusters:
-            result[cluster_name] = []
-            for phrase in phrases:
-                if cluster_name in phrase:
-                    result[cluster_name].append(phrase)
+    def add_candidates(self, graph, candidates):
+        """
+        each node is a unique candidate
+        """
+        graph.add_nodes_from(set(candidates))
+        # iterate over word-pairs, add unweighted edges into graph
+        for w1, w2 in self._to_pairs(candidates):
+            graph.add_edge(*sorted([w1, w2]))
 
-        return result
+    @staticmethod
+    def add_edges(graph, nodes, first, second):
+        graph.add_nodes_from(nodes)
+        graph.add_edges_from(itertools.izip(first, second))
 
+    def rank_graph(self, graph):
+        metrics.increment('pagerank_runs_total', engine='networkx')
+        return networkx.pagerank(graph, alpha=self.damping, max_iter=self.max_iterations, tol=self.tolerance)
 
-class MultipleProvidersKeyphraseExtractor:
-    def __init__(self, providers):
+    @staticmethod
+    def get_graph_size(graph):
+        return graph.number_of_nodes(), graph.number_of_edges()
+
+    @staticmethod
+    def _to_pairs(iterable):
+        """ Converts iterable i to pairs:
+        i -> (i0,i1), (i1,i2), (i2, i3), ..."""
+        a, b = itertools.tee(iterable)
+        next(b, None)
+        return itertools.izip(a, b)
+
+
+class CandidateGraph:
+    """
+    Co-occurrence graph built incrementally from candidate sequences. Candidates are mapped to integer ids,
+    neighbouring pairs of every added sequence are encoded as int64 edge keys in one vectorized pass and
+    deduplicated in batches, so memory is bounded by the number of distinct edges, not by the corpus size.
+    """
+    max_pending_keys = 1 << 20
+
+    def __init__(self):
+        self.index = {}
+        self.vocabulary = []
+        self.edge_keys = numpy.empty(0, dtype=numpy.int64)
+        self.pending_keys = []
+        self.pending_size = 0
+
+    def add_candidates(self, candidates):
+        ids = self.map_to_ids(candidates, self.index, self.vocabulary)
+        if len(ids) < 2:
+            return
+        self.pending_keys.append(self.get_edge_keys(ids))
+        self.pending_size += len(ids) - 1
+        if self.pending_size >= self.max_pending_keys:
+            self._compact()
+
+    def add_edges(self, nodes, first, second):
+        """
+        adds partial results of a graph built elsewhere: nodes in the order of their first occurrence and
+        edges between first[i] and second[i]
+        """
+        self.map_to_ids(nodes, self.index, self.vocabulary)
+        if not len(first):
+            return
+        first_ids = self.map_to_ids(first, self.index, self.vocabulary)
+        second_ids = self.map_to_ids(second, self.index, self.vocabulary)
+        self.pending_keys.append((numpy.minimum(first_ids, second_ids) << 32) | numpy.maximum(first_ids, second_ids))
+        self.pending_size += len(first_ids)
+        if self.pending_size >= self.max_pending_keys:
+            self._compact()
+
+    def get_edges_count(self):
+        self._compact()
+        return len(self.edge_keys)
+
+    def get_adjacency_matrix(self):
+        self._compact()
+        return self.build_adjacency_matrix(self.edge_keys >> 32, self.edge_keys & 0xFFFFFFFF, len(self.vocabulary))
+
+    @staticmethod
+    def map_to_ids(items, index, vocabulary):
+        """
+        maps items to their ids in the index, unseen items are appended to the vocabulary
+        """
+        ids = numpy.empty(len(items), dtype=numpy.int64)
+        for i, item in enumerate(items):
+            item_id = index.get(item)
+            if item_id is None:
+                item_id = index[item] = len(vocabulary)
+                vocabulary.append(item)
+            ids[i] = item_id
+        return ids
+
+    @staticmethod
+    def get_edge_keys(ids):
+        """
+        encodes each pair of neighbouring ids as a single int64 key, lower id in the upper 32 bits
+        """
+        first, second = ids[:-1], ids[1:]
+        return (numpy.minimum(first, second) << 32) | numpy.maximum(first, second)
+
+    @staticmethod
+    def build_adjacency_matrix(low, high, size):
+        """
+        edges are unweighted and undirected, every (low, high) pair is entered in both directions
+        """
+        rows = numpy.concatenate((low, high))
+        cols = numpy.concatenate((high, low))
+        adjacency = scipy.sparse.coo_matrix((numpy.ones(len(rows)), (rows, cols)), shape=(size, size)).tocsr()
+        # self-loops are present in both halves and summed by the conversion, collapse them into single edges
+        adjacency.data[:] = 1.0
+        return adjacency
+
+    def _compact(self):
+        if self.pending_keys:
+            self.edge_keys = numpy.unique(numpy.concatenate([self.edge_keys] + self.pending_keys))
+            self.pending_keys = []
+            self.pending_size = 0
+
+
+class SparseRankingEngine:
+    """
+    TextRank backend working on integer candidate ids, the co-occurrence graph is a CSR adjacency matrix
+    ranked by NumPy/SciPy power iteration with the same semantics as networkx.pagerank
+    """
+    def __init__(self, damping=0.85, tolerance=1.0e-6, max_iterations=100):
+        self.damping = damping
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def get_parameters(self):
+        return {'engine': 'sparse', 'damping': self.damping, 'tolerance': self.tolerance,
+                'max_iterations': self.max_iterations}
+
+    def rank(self, candidates):
+        graph = self.create_graph()
+        self.add_candidates(graph, candidates)
+        return self.rank_graph(graph)
+
+    @staticmethod
+    def create_graph():
+        return CandidateGraph()
+
+    @staticmethod
+    def add_candidates(graph, candidates):
+        graph.add_candidates(candidates)
+
+    @staticmethod
+    def add_edges(graph, nodes, first, second):
+        graph.add_edges(nodes, first, second)
+
+    def rank_graph(self, graph):
+        if not graph.vocabulary:
+            return {}
+        ranks, _ = self.power_iteration(graph.get_adjacency_matrix())
+        return dict(itertools.izip(graph.vocabulary, ranks.tolist()))
+
+    @staticmethod
+    def get_graph_size(graph):
+        return len(graph.vocabulary), graph.get_edges_count()
+
+    def power_iteration(self, adjacency, initial_ranks=None):
+        """
+        returns ranks and the number of iterations done, iteration starts from the uniform distribution
+        unless initial ranks are given, e.g. the ranks of a previous version of the graph
+        """
+        size = adjacency.shape[0]
+        out_degree = numpy.asarray(adjacency.sum(axis=1)).ravel()
+        dangling = out_degree == 0
+        inverse_degree = numpy.zeros(size)
+        inverse_degree[~dangling] = 1.0 / out_degree[~dangling]
+        transposed = adjacency.T.tocsr()
+        if initial_ranks is None:
+            ranks = numpy.repeat(1.0 / size, size)
+        else:
+            ranks = initial_ranks / initial_ranks.sum()
+        for iteration in xrange(1, self.max_iterations + 1):
+            last_ranks = ranks
+            dangling_sum = last_ranks[dangling].sum()
+            ranks = self.damping * (transposed.dot(last_ranks * inverse_degree) + dangling_sum / size) + \
+                (1.0 - self.damping) / size
+            if numpy.abs(ranks - last_ranks).sum() < size * self.tolerance:
+                self._count_run(iteration)
+                return ranks, iteration
+        self._count_run(self.max_iterations)
+        metrics.increment('pagerank_not_converged_total', engine='sparse')
+        get_logger('SparseRankingEngine').warn('PageRank did not converge in {} iterations'.format(
+            self.max_iterations))
+        return ranks, self.max_iterations
+
+    @staticmethod
+    def _count_run(iterations):
+        metrics.increment('pagerank_runs_total', engine='sparse')
+        metrics.increment('pagerank_iterations_total', iterations, engine='sparse')
+
+
+CorpusDocument = collections.namedtuple('CorpusDocument', ['signature', 'words', 'nodes', 'edges'])
+
+
+class CorpusGraph:
+    """
+    Co-occurrence graph of a document corpus that can be updated document by document. Every document keeps
+    its lemma ids and its own distinct nodes and edge keys, the graph keeps for each node and edge the number
+    of documents contributing it, so removing a document only decrements its contributions. Ranking is
+    warm-started from the scores of the previous ranking and the whole state can be persisted between runs.
+    Node ids are local to the graph, its vocabulary maps them to the ids of the shared lemma vocabulary.
+    """
+    def __init__(self, ranking_engine=None):
+        self.ranking_engine = ranking_engine or SparseRankingEngine()
+        self.index = {}
+        self.vocabulary = []
+        self.documents = {}
+        self.node_counts = collections.Counter()
+        self.edge_counts = collections.Counter()
+        self.scores = {}
+
+    def load(self, path):
+        """
+        state is stored as plain containers, so it does not depend on the module the classes are loaded from,
+        lemmas are stored as words and interned again on load
+        """
+        with open(path, 'rb') as f:
+            state = cPickle.load(f)
+        self.vocabulary = [vocabulary.get_id(word) for word in state['vocabulary']]
+        self.index = dict((word, word_id) for word_id, word in enumerate(self.vocabulary))
+        self.documents = dict((name, CorpusDocument(*document)) for name, document in state['documents'].iteritems())
+        self.node_counts = collections.Counter(state['node_counts'])
+        self.edge_counts = collections.Counter(state['edge_counts'])
+        self.scores = state['scores']
+
+    def save(self, path):
+        state = {
+            'vocabulary': [vocabulary.get_word(word_id) for word_id in self.vocabulary],
+            'documents': dict((name, tuple(document)) for name, document in self.documents.iteritems()),
+            'node_counts': dict(self.node_counts),
+            'edge_counts': dict(self.edge_counts),
+            'scores': self.scores
+        }
+        with open(path, 'wb') as f:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+
+    def add_document(self, name, words, candidates, signature=None):
+        if name in self.documents:
+            self.remove_document(name)
+        word_ids = array.array('I', CandidateGraph.map_to_ids(words, self.index, self.vocabulary))
+        candidate_ids = CandidateGraph.map_to_ids(candidates, self.index, self.vocabulary)
+        nodes = numpy.unique(candidate_ids)
+        edges = numpy.unique(CandidateGraph.get_edge_keys(candidate_ids))
+        self.node_counts.update(nodes.tolist())
+        self.edge_counts.update(edges.tolist())
+        self.documents[name] = CorpusDocument(signature, word_ids, nodes, edges)
+
+    def remove_document(self, name):
+        document = self.documents.pop(name)
+        self._decrement(self.node_counts, document.nodes)
+        self._decrement(self.edge_counts, document.edges)
+
+    def get_document_words(self, name):
+        """
+        lemma ids of the document words as a buffer of the shared vocabulary ids
+        """
+        word_ids = numpy.array(self.vocabulary, dtype=numpy.uint32)
+        return word_ids[numpy.frombuffer(self.documents[name].words, dtype=numpy.uint32)]
+
+    def rank(self):
+        """
+        ranks nodes present in at least one document, starting power iteration from the previous scores
+        """
+        active_ids = numpy.array(sorted(self.node_counts), dtype=numpy.int64)
+        if not len(active_ids):
+            self.scores = {}
+            return {}
+        positions = numpy.empty(len(self.vocabulary), dtype=numpy.int64)
+        positions[active_ids] = numpy.arange(len(active_ids))
+        edge_keys = numpy.fromiter(self.edge_counts, dtype=numpy.int64, count=len(self.edge_counts))
+        adjacency = CandidateGraph.build_adjacency_matrix(positions[edge_keys >> 32],
+                                                         positions[edge_keys & 0xFFFFFFFF], len(active_ids))
+        default_score = 1.0 / len(active_ids)
+        initial_ranks = numpy.array([self.scores.get(node_id, default_score) for node_id in active_ids.tolist()])
+        with metrics.time('stage_duration_seconds', stage='pagerank'):
+            ranks, iterations = self.ranking_engine.power_iteration(adjacency, initial_ranks)
+        metrics.increment('graph_nodes_total', len(active_ids))
+        metrics.increment('graph_edges_total', len(edge_keys))
+        get_logger('CorpusGraph').info('Ranked {} nodes and {} edges in {} iterations'.format(
+            len(active_ids), len(edge_keys), iterations))
+        self.scores = dict(itertools.izip(active_ids.tolist(), ranks.tolist()))
+        return self.get_ranks()
+
+    def get_ranks(self):
+        vocabulary = self.vocabulary
+        return dict((vocabulary[node_id], score) for node_id, score in self.scores.iteritems())
+
+    @staticmethod
+    def _decrement(counter, keys):
+        for key in keys.tolist():
+            counter[key] -= 1
+            if not counter[key]:
+                del counter[key]
+
+
+RANKING_ENGINES = {
+    'sparse': SparseRankingEngine,
+    'networkx': NetworkxRankingEngine
+}
+
+
+class BatchKeyphraseExtractor(KeyphraseExtractor):
+    """
+    Extracts keyphrases of many providers at once. Sentences of consecutive documents are collected until
+    there are at least batch_sentences of them and tagged together in one call of the shared tagger, each
+    document is then ranked on its own exactly as by KeyphraseExtractor.
+    """
+    def __init__(self, providers, ranking_engine=None, result_cache=None, batch_sentences=2000, progress=None):
+        KeyphraseExtractor.__init__(self, None, ranking_engine, result_cache, progress)
+        self.logger = get_logger('BatchKeyphraseExtractor')
         self.providers = providers
-        self.logger = get_logger('MultipleProvidersKeyphraseExtractor')
+        self.batch_sentences = batch_sentences
 
     def extract_keyphrases_map_by_textrank(self):
-        keyphrases_dict = {}
+        """
+        returns title -> keyphrases map, keyphrases of sources that fail to provide content are None
+        """
+        keyphrases_map = {}
+        batch = []
+        batch_sentences = 0
+        self._report_progress('reading', 0, len(self.providers))
         for provider in self.providers:
-            extractor = KeyphraseExtractor(provider)
+            self._report_progress('reading')
             title = provider.get_title()
+            provider_name = provider.__class__.__name__
+            metrics.increment('documents_total', provider=provider_name)
             try:
-                keyphrases = extractor.extract_keyphrases_by_textrank()
-                top_keyphrases = extractor.get_top_keyphrases(keyphrases, 0.2)
-                keyphrases_dict[title] = top_keyphrases
+                with metrics.time('provider_content_seconds', provider=provider_name):
+                    chunks = list(provider.iter_content())
             except ContentProviderException:
-                self.logger.warn('Could not extract keyphrases from source entitled {}'.format(title))
+                metrics.increment('provider_errors_total', provider=provider_name)
+                keyphrases_map[title] = None
+                self._report_progress('reading', len(keyphrases_map))
+                continue
+            key = None
+            if self.result_cache is not None:
+                key = self.result_cache.get_key(chunks, self.get_parameters())
+                keyphrases = self.result_cache.get(key)
+                if keyphrases is not None:
+                    keyphrases_map[title] = keyphrases
+                    self._report_progress('reading', len(keyphrases_map))
+                    continue
+            chunks_sentences = [self._split_sentences(chunk) for chunk in chunks]
+            batch.append((title, key, chunks_sentences))
+            batch_sentences += sum(len(sentences) for sentences in chunks_sentences)
+            if batch_sentences >= self.batch_sentences:
+                self._extract_batch(batch, keyphrases_map)
+                batch = []
+                batch_sentences = 0
+        if batch:
+            self._extract_batch(batch, keyphrases_map)
+        self._report_progress('done')
+        return keyphrases_map
+
+    def _extract_batch(self, batch, keyphrases_map):
+        sentences = [sentence for _, _, chunks_sentences in batch
+                     for chunk_sentences in chunks_sentences for sentence in chunk_sentences]
+        self.logger.info('Tagging %d sentences of %d documents', len(sentences), len(batch))
+        self._report_progress('tagging')
+        analyzed_sentences = iter(self._analyze_sentences(sentences))
+        for title, key, chunks_sentences in batch:
+            streams = []
+            for chunk_sentences in chunks_sentences:
+                tokens = self._get_tokens(list(itertools.islice(analyzed_sentences, len(chunk_sentences))))
+                streams.append((self._get_words(tokens), self._get_candidate_words(tokens, self.good_tags)))
+            keyphrases = self._extract_keyphrases_from_streams(streams)
+            if key is not None:
+                self.result_cache.put(key, keyphrases)
+            keyphrases_map[title] = keyphrases
+            self._report_progress('ranking', len(keyphrases_map))
+
+
+class MultipleProvidersKeyphraseExtractor:
+    def __init__(self, providers, ranking_engine=None, workers=1, chunk_size=None, result_cache=None,
+                 progress=None):
+        self.providers = providers
+        self.ranking_engine = ranking_engine
+        self.result_cache = result_cache
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.logger = get_logger('MultipleProvidersKeyphraseExtractor')
+
+    def extract_keyphrases_map_by_textrank(self):
+        keyphrases_dict = {}
+        if self.workers > 1 and len(self.providers) > 1:
+            results = self._extract_in_process_pool()
+        else:
+            results = extract_batch_top_keyphrases((self.providers, self.ranking_engine, self.result_cache),
+                                                   self.progress)
+        for title, top_keyphrases in results:
+            if top_keyphrases is None:
+                self.logger.warn('Could not extract keyphrases from source entitled %s', title)
+            else:
+                keyphrases_dict[title] = top_keyphrases
         return keyphrases_dict
 
+    def _extract_in_process_pool(self):
+        """
+        every task is a batch of chunk_size providers extracted together by one worker
+        """
+        chunk_size = self.chunk_size or self._get_default_chunk_size(len(self.providers))
+        tasks = [(self.providers[i:i + chunk_size], self.ranking_engine, self.result_cache)
+                 for i in xrange(0, len(self.providers), chunk_size)]
+        self.logger.info('Extracting {} sources with {} workers in chunks of {}'.format(
+            len(self.providers), self.workers, chunk_size))
+        pool = multiprocessing.Pool(self.workers, initializer=load_nlp_models)
+        try:
+            results = []
+            if self.progress is not None:
+                self.progress.report('extracting', 0, len(self.providers))
+            for task_results, metrics_state in pool.imap_unordered(extract_batch_top_keyphrase_words, tasks):
+                results.extend(task_results)
+                metrics.merge_state(metrics_state)
+                if self.progress is not None:
+                    self.progress.report('extracting', len(results))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return [(title, vocabulary.from_words(top_keyphrases) if top_keyphrases is not None else None)
+                for title, top_keyphrases in results]
+
+    def _get_default_chunk_size(self, tasks_count):
+        chunk_size, extra = divmod(tasks_count, self.workers * 4)
+        return chunk_size + 1 if extra else max(chunk_size, 1)
+
+
+class ShardedKeyphraseExtractor(KeyphraseExtractor):
+    """
+    Map-reduce extraction of large inputs. Sentences of every chunk are split into shards of shard_sentences
+    sentences, which are tokenized, tagged and filtered by a pool of worker processes. Every shard comes back
+    with its word and candidate streams and its partial graph: candidates in the order of their first
+    occurrence and the distinct edges between neighbouring candidates. Partial graphs are reduced in shard
+    order into one graph, together with the edge between the last candidate of a shard and the first one of
+    the next shard of the same chunk, and word streams of a chunk are concatenated, so keyphrases are the same
+    as extracted by KeyphraseExtractor in a single process.
+    """
+    def __init__(self, provider, ranking_engine=None, result_cache=None, workers=2, shard_sentences=2000,
+                 progress=None):
+        KeyphraseExtractor.__init__(self, provider, ranking_engine, result_cache, progress)
+        self.logger = get_logger('ShardedKeyphraseExtractor')
+        self.workers = workers
+        self.shard_sentences = shard_sentences
+
+    def _extract_keyphrases_from_chunks(self, chunks):
+        # shard tasks are produced lazily, only the first two are taken to tell whether a pool is worth it
+        tasks = self._get_shard_tasks(chunks)
+        first_tasks = list(itertools.islice(tasks, 2))
+        tasks = itertools.chain(first_tasks, tasks)
+        self.logger.info('Starting keyphrase extraction in shards of {} sentences with {} workers...'.format(
+            self.shard_sentences, self.workers))
+        if self.workers > 1 and len(first_tasks) > 1:
+            pool = multiprocessing.Pool(self.workers, initializer=load_nlp_models)
+            try:
+                keyphrases = self._reduce_shards(pool.imap(analyze_shard_in_worker, tasks))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            keyphrases = self._reduce_shards((analyze_shard(task), None) for task in tasks)
+        self._report_progress('done', 1)
+        return keyphrases
+
+    def _get_shard_tasks(self, chunks):
+        for chunk_index, chunk in enumerate(chunks):
+            with metrics.time('stage_duration_seconds', stage='sentence_split'):
+                sentences = nltk.sent_tokenize(chunk)
+            for start in xrange(0, len(sentences), self.shard_sentences):
+                yield chunk_index, sentences[start:start + self.shard_sentences], self.good_tags
+
+    def _reduce_shards(self, shards):
+        graph = self.ranking_engine.create_graph()
+        chunks_words = WordsSpool()
+        try:
+            chunk_words = []
+            last_chunk_index = None
+            last_candidate = None
+            # the number of shards is not known before the chunks are read
+            self._report_progress('analyzing', 0, 0)
+            for shard_index, (shard, metrics_state) in enumerate(shards):
+                if metrics_state is not None:
+                    metrics.merge_state(metrics_state)
+                chunk_index, shard_words, words, nodes, first, second, shard_last_candidate = shard
+                with metrics.time('stage_duration_seconds', stage='reduce'):
+                    if chunk_index != last_chunk_index:
+                        if chunk_words:
+                            chunks_words.append(self._concatenate(chunk_words))
+                        chunk_words = []
+                        last_chunk_index = chunk_index
+                        last_candidate = None
+                    # local ids of the shard are mapped to lemma ids of this process by their words
+                    lemma_ids = numpy.array([vocabulary.get_id(word) for word in shard_words], dtype=numpy.uint32)
+                    chunk_words.append(lemma_ids[words])
+                    nodes = lemma_ids[nodes].tolist()
+                    self.ranking_engine.add_edges(graph, nodes, lemma_ids[first].tolist(), lemma_ids[second].tolist())
+                    if nodes:
+                        # the first candidate of a shard is always the first node
+                        if last_candidate is not None:
+                            self.ranking_engine.add_edges(graph, [], [last_candidate], [nodes[0]])
+                        last_candidate = int(lemma_ids[shard_last_candidate])
+                self._report_progress('analyzing', shard_index + 1)
+            if chunk_words:
+                chunks_words.append(self._concatenate(chunk_words))
+            self._report_progress('ranking')
+            return self._extract_keyphrases_from_graph(graph, chunks_words)
+        finally:
+            chunks_words.close()
+
+    @staticmethod
+    def _concatenate(arrays):
+        return array.array('I', numpy.concatenate(arrays).tostring())
+
+
+class IncrementalCorpusExtractor(KeyphraseExtractor):
+    """
+    Keeps keyphrases of a directory current between runs: the corpus graph state is loaded from state_path,
+    only added, changed and removed files are processed, ranks are warm-started and the state is saved back
+    """
+    def __init__(self, dir_path, state_path, ranking_engine=None):
+        KeyphraseExtractor.__init__(self, DirectoryContentProvider(dir_path), ranking_engine)
+        self.logger = get_logger('IncrementalCorpusExtractor')
+        self.dir_path = dir_path
+        self.state_path = state_path
+
+    def extract_keyphrases_by_textrank(self):
+        corpus = self._load_corpus()
+        modified = self._synchronize_corpus(corpus)
+        ranks = corpus.rank() if modified or not corpus.scores else corpus.get_ranks()
+        word_ranks = self._select_top_word_ranks(ranks)
+        keywords = set(word_ranks.keys())
+        keyphrases = collections.OrderedDict()
+        for name in sorted(corpus.documents):
+            self._merge_keywords_into_keyphrases(keywords, word_ranks, corpus.get_document_words(name),
+                                                 self.keyphrase_window, keyphrases)
+        result = sorted(keyphrases.items(), key=operator.itemgetter(1), reverse=True)
+        corpus.save(self.state_path)
+        self.logger.info('Saved corpus state to "{}"'.format(self.state_path))
+        return RankedKeyphrases(self._normalize_weights(result) if result else result)
+
+    def _load_corpus(self):
+        corpus = CorpusGraph(self.ranking_engine)
+        if os.path.isfile(self.state_path):
+            self.logger.info('Loading corpus state from "{}"'.format(self.state_path))
+            corpus.load(self.state_path)
+        else:
+            self.logger.info('No corpus state found, building it from scratch')
+        return corpus
+
+    def _synchronize_corpus(self, corpus):
+        signatures = {}
+        for path in DirectoryContentLister(self.dir_path).get_content_list():
+            stat = os.stat(path)
+            signatures[path] = (stat.st_mtime, stat.st_size)
+        removed = [name for name in corpus.documents if name not in signatures]
+        for name in removed:
+            corpus.remove_document(name)
+        changed = [path for path in sorted(signatures)
+                   if path not in corpus.documents or corpus.documents[path].signature != signatures[path]]
+        for path in changed:
+            tokens = self._analyze_text(FileContentProvider(path).get_content())
+            corpus.add_document(path, self._get_words(tokens), self._get_candidate_words(tokens, self.good_tags),
+                                signatures[path])
+        self.logger.info('Corpus updated: {} documents added or changed, {} removed, {} unchanged'.format(
+            len(changed), len(removed), len(signatures) - len(changed)))
+        return bool(changed or removed)
+
+
+class PreprocessedCorpus:
+    """
+    Binary file of analyzed documents, so that they can be extracted again without running NLTK. The file
+    starts with a magic string, the length of a JSON header and the header itself, which holds the POS table,
+    the document names and the offset, type and length of every section. Sections are 8 byte aligned arrays:
+    vocabulary offsets and UTF-8 vocabulary data, lemma id, POS tag id and flags of every token, and the token
+    offsets of every document. The file is opened with memory-mapping, only the vocabulary is read eagerly to
+    intern it into the shared vocabulary, tokens of a document are read when the document is requested.
+    """
+    magic = 'AKECORP\0'
+    version = 1
+    excluded_flag = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = []
+        self.document_names = []
+        self.document_index = {}
+        self.sections = {}
+        self.lemma_ids = None
+
+    def open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                prefix = f.read(len(self.magic) + 8)
+                if prefix[:len(self.magic)] != self.magic:
+                    raise ValueError('not a preprocessed corpus')
+                header_length, = struct.unpack('<Q', prefix[len(self.magic):])
+                header = json.loads(f.read(header_length))
+            if header['version'] != self.version:
+                raise ValueError('unsupported version {}'.format(header['version']))
+        except (IOError, ValueError, struct.error) as e:
+            get_logger('PreprocessedCorpus').error('Could not open preprocessed corpus "{}": {}'.format(self.path, e))
+            raise ContentProviderException()
+        data = numpy.memmap(self.path, dtype=numpy.uint8, mode='r')
+        for name, (offset, dtype, count) in header['sections'].iteritems():
+            dtype = numpy.dtype(dtype)
+            self.sections[name] = data[offset:offset + count * dtype.itemsize].view(dtype)
+        self.tags = header['tags']
+        self.document_names = header['documents']
+        self.document_index = dict((name, index) for index, name in enumerate(self.document_names))
+        vocabulary_offsets = self.sections['vocabulary_offsets'].tolist()
+        vocabulary_data = self.sections['vocabulary_data']
+        self.lemma_ids = numpy.array([vocabulary.get_id(vocabulary_data[start:end].tostring()) for start, end in
+                                      itertools.izip(vocabulary_offsets, vocabulary_offsets[1:])], dtype=numpy.uint32)
+        return self
+
+    def get_document_names(self):
+        return list(self.document_names)
+
+    def get_words(self, name):
+        """
+        ids of the document lemmas in the shared vocabulary
+        """
+        return self._to_array(self.lemma_ids[self._get_section(name, 'lemmas')])
+
+    def get_candidate_words(self, name, good_tags):
+        """
+        ids of the lemmas of document words tagged with good tags that are neither stop words nor punctuation
+        """
+        good_tags_mask = numpy.array([tag in good_tags for tag in self.tags], dtype=bool)
+        candidates_mask = good_tags_mask[self._get_section(name, 'tags')] & \
+            (self._get_section(name, 'flags') & self.excluded_flag == 0)
+        return self._to_array(self.lemma_ids[self._get_section(name, 'lemmas')[candidates_mask]])
+
+    def _get_section(self, name, section):
+        document_offsets = self.sections['document_offsets']
+        index = self.document_index[name]
+        return self.sections[section][document_offsets[index]:document_offsets[index + 1]]
+
+    @staticmethod
+    def _to_array(ids):
+        return array.array('I', ids.astype(numpy.uint32).tostring())
+
+    @staticmethod
+    def write(path, documents):
+        """
+        documents are (name, tokens) pairs, tokens as produced by KeyphraseExtractor._analyze_text
+        """
+        stop_words = nlp_models.get_stop_words()
+        punctuation = nlp_models.punctuation
+        lemma_index, lemmas = {}, []
+        tag_index, tags = {}, []
+        names, document_offsets = [], [0]
+        lemma_arrays, tag_arrays, flag_arrays = [], [], []
+        for name, tokens in documents:
+            names.append(name)
+            document_offsets.append(document_offsets[-1] + len(tokens))
+            lemma_arrays.append(CandidateGraph.map_to_ids([token.lemma_id for token in tokens], lemma_index, lemmas))
+            tag_arrays.append(CandidateGraph.map_to_ids([token.tag for token in tokens], tag_index, tags))
+            flag_arrays.append(numpy.array([token.word.lower() in stop_words or all(
+                char in punctuation for char in token.word) for token in tokens], dtype=bool))
+        if len(tags) > 256:
+            raise ValueError('too many POS tags')
+        encoded_lemmas = [PreprocessedCorpus._encode(vocabulary.get_word(lemma_id)) for lemma_id in lemmas]
+        arrays = [
+            ('vocabulary_offsets', numpy.cumsum([0] + [len(lemma) for lemma in encoded_lemmas], dtype=numpy.uint64)),
+            ('vocabulary_data', numpy.fromstring(''.join(encoded_lemmas), dtype=numpy.uint8)),
+            ('lemmas', PreprocessedCorpus._concatenate(lemma_arrays, numpy.uint32)),
+            ('tags', PreprocessedCorpus._concatenate(tag_arrays, numpy.uint8)),
+            ('flags', PreprocessedCorpus._concatenate(flag_arrays, numpy.uint8) * PreprocessedCorpus.excluded_flag),
+            ('document_offsets', numpy.array(document_offsets, dtype=numpy.uint64))
+        ]
+        # offsets in the header depend on its length, grow it until they stabilize
+        header_length = 0
+        while True:
+            sections = {}
+            offset = PreprocessedCorpus._align(len(PreprocessedCorpus.magic) + 8 + header_length)
+            for name, values in arrays:
+                sections[name] = (offset, values.dtype.str, len(values))
+                offset = PreprocessedCorpus._align(offset + values.nbytes)
+            header = json.dumps({'version': PreprocessedCorpus.version, 'tags': tags, 'documents': names,
+                                 'sections': sections}, sort_keys=True)
+            if len(header) <= header_length:
+                break
+            header_length = len(header)
+        header += ' ' * (header_length - len(header))
+        with open(path, 'wb') as f:
+            f.write(PreprocessedCorpus.magic)
+            f.write(struct.pack('<Q', header_length))
+            f.write(header)
+            for name, values in arrays:
+                f.write('\0' * (sections[name][0] - f.tell()))
+                f.write(values.tostring())
+        return len(names), document_offsets[-1], len(lemmas)
+
+    @staticmethod
+    def _encode(word):
+        return word.encode('utf-8') if isinstance(word, unicode) else word
+
+    @staticmethod
+    def _concatenate(arrays, dtype):
+        return numpy.concatenate(arrays).astype(dtype) if arrays else numpy.empty(0, dtype=dtype)
+
+    @staticmethod
+    def _align(offset):
+        return (offset + 7) & ~7
+
+
+class PreprocessedCorpusExtractor(KeyphraseExtractor):
+    """
+    Extracts keyphrases of documents of a preprocessed corpus, either of the given documents together, each of
+    them being an independent chunk, or of every document separately
+    """
+    def __init__(self, corpus, document_names=None, ranking_engine=None):
+        KeyphraseExtractor.__init__(self, None, ranking_engine)
+        self.logger = get_logger('PreprocessedCorpusExtractor')
+        self.corpus = corpus
+        self.document_names = document_names if document_names is not None else corpus.get_document_names()
+
+    def extract_keyphrases_by_textrank(self):
+        self.logger.info('Getting {} documents from preprocessed corpus "{}"'.format(len(self.document_names),
+                                                                                   self.corpus.path))
+        return self._extract_keyphrases_from_streams(self._get_streams(self.document_names))
+
+    def extract_keyphrases_map_by_textrank(self):
+        keyphrases_map = {}
+        for name in self.document_names:
+            keyphrases = self._extract_keyphrases_from_streams(self._get_streams([name]))
+            keyphrases_map[name] = self.get_top_keyphrases(keyphrases, 0.2)
+        return keyphrases_map
+
+    def _get_streams(self, document_names):
+        for name in document_names:
+            yield self.corpus.get_words(name), self.corpus.get_candidate_words(name, self.good_tags)
+
+
+class CorpusPreprocessor:
+    """
+    Analyzes a file or every file of a directory once and writes the token streams into a preprocessed corpus
+    """
+    def __init__(self, configuration):
+        self.path = configuration.path
+        self.output = configuration.output
+        self.logger = get_logger('CorpusPreprocessor')
+        lemma_cache.resize(configuration.lemma_cache_size)
+        sentence_cache.resize(configuration.sentence_cache_size)
+
+    def run(self):
+        try:
+            time_start = time.time()
+            documents_count, tokens_count, lemmas_count = PreprocessedCorpus.write(self.output, self._analyze())
+            self.logger.info('Wrote {} documents, {} tokens and {} lemmas to "{}" in {:.3f} seconds'.format(
+                documents_count, tokens_count, lemmas_count, self.output, time.time() - time_start))
+        except ContentProviderException:
+            self.logger.error('Failed to retrieve content for preprocessing')
+
+    def _analyze(self):
+        if os.path.isdir(self.path):
+            paths = DirectoryContentLister(self.path).get_content_list()
+        else:
+            paths = [self.path]
+        for path in paths:
+            provider = FileContentProvider(path)
+            yield path, KeyphraseExtractor(provider)._analyze_text(provider.get_content())
+
+
+def extract_batch_top_keyphrases(task, progress=None):
+    """
+    Extracts top keyphrases of a (providers, ranking_engine, result_cache) task, module level so that it can be
+    run by process pool workers; returns (title, top keyphrases) pairs, sources that fail to provide content
+    are reported with None keyphrases
+    """
+    providers, ranking_engine, result_cache = task
+    extractor = BatchKeyphraseExtractor(providers, ranking_engine, result_cache, progress=progress)
+    keyphrases_map = extractor.extract_keyphrases_map_by_textrank()
+    return [(title, KeyphraseExtractor.get_top_keyphrases(keyphrases, 0.2) if keyphrases is not None else None)
+            for title, keyphrases in keyphrases_map.iteritems()]
+
+
+def extract_batch_top_keyphrase_words(task):
+    """
+    Same as extract_batch_top_keyphrases, with keyphrases as words, because lemma ids of a process pool worker
+    are not valid in the parent process; metrics recorded by the task are sent along to be merged by the parent
+    """
+    metrics.reset()
+    results = [(title, vocabulary.to_words(top_keyphrases) if top_keyphrases is not None else None)
+               for title, top_keyphrases in extract_batch_top_keyphrases(task)]
+    return results, metrics.get_state()
+
+
+def analyze_shard(task):
+    """
+    Map step of ShardedKeyphraseExtractor, tokenizes, tags and filters a (chunk index, sentences, good tags)
+    task. Lemma ids are valid only in the process that assigned them, so the shard returns its own words and
+    streams of local ids: (chunk index, words, word stream, candidates in the order of their first occurrence,
+    first and second ends of distinct edges between neighbouring candidates, last candidate or -1)
+    """
+    chunk_index, sentences, good_tags = task
+    extractor = KeyphraseExtractor(None)
+    tokens = extractor._get_tokens(extractor._analyze_sentences(sentences))
+    words = numpy.frombuffer(extractor._get_words(tokens), dtype=numpy.uint32)
+    candidates = numpy.frombuffer(extractor._get_candidate_words(tokens, good_tags), dtype=numpy.uint32)
+    lemma_ids, local_ids = numpy.unique(numpy.concatenate((words, candidates)), return_inverse=True)
+    shard_words = [vocabulary.get_word(lemma_id) for lemma_id in lemma_ids.tolist()]
+    local_words, local_candidates = local_ids[:len(words)], local_ids[len(words):]
+    _, first_occurrences = numpy.unique(local_candidates, return_index=True)
+    nodes = local_candidates[numpy.sort(first_occurrences)]
+    edge_keys = numpy.unique(CandidateGraph.get_edge_keys(local_candidates.astype(numpy.int64)))
+    last_candidate = local_candidates[-1] if len(local_candidates) else -1
+    return chunk_index, shard_words, local_words, nodes, edge_keys >> 32, edge_keys & 0xFFFFFFFF, last_candidate
+
+
+def analyze_shard_in_worker(task):
+    """
+    Same as analyze_shard, metrics recorded by the task are sent along to be merged by the parent
+    """
+    metrics.reset()
+    shard = analyze_shard(task)
+    return shard, metrics.get_state()
+
 
 class AbstractContentProvider:
+    streaming = False
+
     def __init__(self, name, title):
         self.logger = get_logger(name)
         self.title = title
@@ -322,9 +2147,25 @@ class AbstractContentProvider:
     def get_content(self):
         raise NotImplemented()
 
+    def iter_content(self):
+        """
+        yields text in independent chunks, streaming providers read them lazily one at a time
+        """
+        yield self.get_content()
+
     def get_title(self):
         return self.title
 
+    def __getstate__(self):
+        # loggers cannot be pickled, providers are sent to process pool workers without them
+        state = self.__dict__.copy()
+        del state['logger']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = get_logger(self.__class__.__name__)
+
 
 class ContentProviderException(Exception):
     def __init__(self):
@@ -336,16 +2177,22 @@ class ConfigurationException(Exception):
         pass
 
 
+class ExtractionCancelledException(Exception):
+    def __init__(self):
+        pass
+
+
 class WikipediaException(Exception):
     def __init__(self):
         pass
 
 
 class WikipediaContentProvider(AbstractContentProvider):
-    def __init__(self, titles):
+    def __init__(self, titles, cache=None):
         AbstractContentProvider.__init__(self, 'WikipediaContentProvider', titles)
         self.titles = [s.strip() for s in titles.split(',')]
-        self.logger.info('Initialized with titles "{}"'.format(titles))
+        self.cache = cache
+        self.logger.info('Initialized with titles "%s"', titles)
 
     def get_content(self):
         self.logger.info('Trying to get Wikipedia pages...')
@@ -359,21 +2206,39 @@ class WikipediaContentProvider(AbstractContentProvider):
             contents.append(self._get_page_content(title))
         return contents
 
-    @staticmethod
-    def _get_page_content(title):
+    def _get_page_content(self, title):
+        if self.cache is not None:
+            content = self.cache.get_content(title)
+            if content is not None:
+                self.logger.info('Got page "%s" from cache', title)
+                return content
+            if self.cache.offline:
+                self.logger.error('Page "{}" is not cached, cannot get it in offline mode'.format(title))
+                raise ContentProviderException()
         try:
             page_finder = WikipediaPageFinder(title)
             page = page_finder.get_wikipedia_page()
-            return page.content
         except WikipediaException:
             raise ContentProviderException()
+        if self.cache is not None:
+            self.cache.put(title, page.content, page.revision_id)
+        return page.content
+
+
+class TextContentProvider(AbstractContentProvider):
+    def __init__(self, title, text):
+        AbstractContentProvider.__init__(self, 'TextContentProvider', title)
+        self.text = text
+
+    def get_content(self):
+        return self.text
 
 
 class FileContentProvider(AbstractContentProvider):
     def __init__(self, path):
         AbstractContentProvider.__init__(self, 'FileContentProvider', path)
         self.path = path
-        self.logger.info('Initialized with file path "{}"'.format(self.path))
+        self.logger.info('Initialized with file path "%s"', self.path)
 
     def get_content(self):
         try:
@@ -388,23 +2253,23 @@ class FileContentProvider(AbstractContentProvider):
 
 
 class DirectoryContentProvider(AbstractContentProvider):
+    streaming = True
+
     def __init__(self, dir_path):
         AbstractContentProvider.__init__(self, 'DirectoryContentProvider', dir_path)
         self.dir_path = dir_path
-        self.logger.info('Initialized with directory path "{}"'.format(self.dir_path))
+        self.logger.info('Initialized with directory path "%s"', self.dir_path)
 
     def get_content(self):
         self.logger.info('Reading directory content...')
-        contents = self._get_directory_contents()
+        contents = list(self.iter_content())
         self.logger.info('Directory content ready')
-        return ''.join(contents)
+        return '\n'.join(contents)
 
-    def _get_directory_contents(self):
-        contents = []
+    def iter_content(self):
         content_list = DirectoryContentLister(self.dir_path).get_content_list()
         for file_path in content_list:
-            contents.append(self._get_single_file_content(file_path))
-        return contents
+            yield self._get_single_file_content(file_path)
 
     def _get_single_file_content(self, path):
         try:
@@ -419,13 +2284,13 @@ class WikipediaPageFinder:
     def __init__(self, title):
         self.title = title
         self.logger = get_logger("WikipediaPageFinder")
-        self.logger.info('Initialized with title "{}"'.format(title))
+        self.logger.info('Initialized with title "%s"', title)
 
     def get_wikipedia_page(self):
         try:
-            self.logger.info('Looking for page "{}"'.format(self.title))
+            self.logger.info('Looking for page "%s"', self.title)
             page = wikipedia.page(self.title)
-            self.logger.info('Got page entitled: "{}"'.format(page.title))
+            self.logger.info('Got page entitled: "%s"', page.title)
             return page
         except wikipedia.exceptions.DisambiguationError as e:
             self.logger.error(
@@ -439,6 +2304,259 @@ class WikipediaPageFinder:
             raise WikipediaException()
 
 
+class AbstractSqliteCache:
+    """
+    Base of persistent caches kept in a SQLite file, the connection is opened lazily so that caches can be
+    pickled and sent to process pool workers, each of which opens its own connection
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _create_schema(self, connection):
+        raise NotImplemented()
+
+    def _get_connection(self):
+        if self.connection is None:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._create_schema(self.connection)
+            self.connection.commit()
+        return self.connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lock'] = None
+        state['connection'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class WikipediaContentCache(AbstractSqliteCache):
+    """
+    Persistent SQLite cache of Wikipedia pages keyed by normalized title. Content and links are stored
+    zlib-compressed together with the revision id, entries older than ttl seconds are refetched unless
+    in offline mode, which serves only from the cache. Once the compressed size exceeds max_size bytes
+    the least recently used pages are evicted.
+    """
+    def __init__(self, path, ttl=86400, max_size=256 * 1024 * 1024, offline=False):
+        AbstractSqliteCache.__init__(self, path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+
+    @staticmethod
+    def normalize_title(title):
+        title = ' '.join(title.replace('_', ' ').split())
+        return title[:1].upper() + title[1:]
+
+    def get_content(self, title):
+        content = self._get(title, 'content')
+        return content.decode('utf-8') if content is not None else None
+
+    def get_links(self, title):
+        links = self._get(title, 'links')
+        return json.loads(links) if links is not None else None
+
+    def put(self, title, content, revision=None, links=None):
+        key = self.normalize_title(title)
+        compressed_content = zlib.compress(content.encode('utf-8'))
+        with self.lock:
+            connection = self._get_connection()
+            if links is not None:
+                compressed_links = sqlite3.Binary(zlib.compress(json.dumps(links)))
+            else:
+                row = connection.execute('SELECT links FROM pages WHERE title = ?', (key,)).fetchone()
+                compressed_links = row[0] if row else None
+            size = len(compressed_content) + (len(compressed_links) if compressed_links is not None else 0)
+            now = time.time()
+            connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, sqlite3.Binary(compressed_content), compressed_links, revision, now, now, size))
+            self._evict(connection)
+            connection.commit()
+
+    def _get(self, title, column):
+        key = self.normalize_title(title)
+        with self.lock:
+            connection = self._get_connection()
+            row = connection.execute('SELECT {}, fetched_at FROM pages WHERE title = ?'.format(column),
+                                     (key,)).fetchone()
+            if row is None or row[0] is None:
+                metrics.increment('cache_misses_total', cache='wiki_' + column)
+                return None
+            if not self.offline and time.time() - row[1] > self.ttl:
+                metrics.increment('cache_expired_total', cache='wiki_' + column)
+                return None
+            metrics.increment('cache_hits_total', cache='wiki_' + column)
+            connection.execute('UPDATE pages SET accessed_at = ? WHERE title = ?', (time.time(), key))
+            connection.commit()
+            return zlib.decompress(bytes(row[0]))
+
+    def _evict(self, connection):
+        total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        lru_pages = connection.execute('SELECT title, size FROM pages ORDER BY accessed_at').fetchall()
+        for key, size in lru_pages:
+            if total_size <= self.max_size:
+                break
+            connection.execute('DELETE FROM pages WHERE title = ?', (key,))
+            total_size -= size
+
+    def _create_schema(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, content BLOB NOT NULL, '
+                           'links BLOB, revision INTEGER, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                           'size INTEGER NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+
+
+class KeyphraseResultCache(AbstractSqliteCache):
+    """
+    Persistent SQLite cache of normalized keyphrase lists keyed by a hash of the document content
+    and the extractor parameters, so unchanged documents are not extracted again. Keyphrases are
+    stored as lists of words and interned into the shared vocabulary when read.
+    """
+    format_version = 2
+
+    def __init__(self, path):
+        AbstractSqliteCache.__init__(self, path)
+
+    @staticmethod
+    def get_key(chunks, parameters):
+        digest = hashlib.sha1(json.dumps(parameters, sort_keys=True))
+        digest.update(str(KeyphraseResultCache.format_version))
+        for chunk in chunks:
+            digest.update(chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk)
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self._get_connection().execute('SELECT keyphrases FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            metrics.increment('cache_misses_total', cache='keyphrases')
+            return None
+        metrics.increment('cache_hits_total', cache='keyphrases')
+        return RankedKeyphrases(vocabulary.from_words(json.loads(zlib.decompress(bytes(row[0])))))
+
+    def put(self, key, keyphrases):
+        compressed_keyphrases = sqlite3.Binary(zlib.compress(json.dumps(vocabulary.to_words(keyphrases))))
+        with self.lock:
+            connection = self._get_connection()
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                               (key, compressed_keyphrases, time.time()))
+            connection.commit()
+
+    def _create_schema(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, keyphrases BLOB NOT NULL, '
+                           'created_at REAL NOT NULL)')
+
+
+class WikipediaPagesFetcher:
+    """
+    Fetches plain text content of many Wikipedia pages concurrently, all requests share one pooled HTTP session
+    """
+    def __init__(self, concurrency=8, timeout=10, api_url=WIKIPEDIA_API_URL, cache=None, progress=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.api_url = api_url
+        self.cache = cache
+        self.progress = progress
+        self.logger = get_logger('WikipediaPagesFetcher')
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'IWI-AKE (https://github.com/wilqor/IWI-AKE)'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_all(self, titles):
+        """
+        returns title -> content map of successfully fetched pages, failed fetches are logged and skipped
+        """
+        contents, missing_titles = self._get_cached_contents(titles)
+        if not missing_titles:
+            return contents
+        if self.cache is not None and self.cache.offline:
+            self.logger.warn('Skipping {} pages missing from cache in offline mode'.format(len(missing_titles)))
+            return contents
+        done = len(contents)
+        total = done + len(missing_titles)
+        pool = multiprocessing.pool.ThreadPool(self.concurrency)
+        try:
+            for title, content in pool.imap_unordered(self._fetch_or_skip, missing_titles):
+                if content is not None:
+                    contents[title] = content
+                done += 1
+                if self.progress is not None:
+                    self.progress.report('fetching', done, total)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return contents
+
+    def fetch(self, title):
+        params = {
+            'action': 'query',
+            'prop': 'extracts|revisions',
+            'explaintext': '',
+            'rvprop': 'ids',
+            'redirects': '',
+            'titles': title,
+            'format': 'json'
+        }
+        response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        for page in response.json()['query']['pages'].values():
+            if 'missing' not in page and 'extract' in page:
+                if self.cache is not None:
+                    revisions = page.get('revisions') or [{}]
+                    self.cache.put(title, page['extract'], revisions[0].get('revid'))
+                return page['extract']
+        raise WikipediaException()
+
+    def _get_cached_contents(self, titles):
+        if self.cache is None:
+            return {}, list(titles)
+        contents = {}
+        missing_titles = []
+        for title in titles:
+            content = self.cache.get_content(title)
+            if content is None:
+                missing_titles.append(title)
+            else:
+                contents[title] = content
+        self.logger.info('Got {} of {} pages from cache'.format(len(contents), len(contents) + len(missing_titles)))
+        return contents, missing_titles
+
+    def _fetch_or_skip(self, title):
+        outcome = 'error'
+        time_start = time.time()
+        try:
+            content = self.fetch(title)
+            outcome = 'ok'
+            return title, content
+        except requests.exceptions.RequestException as e:
+            self.logger.warn('Could not fetch page "%s" due to error: %s', title, e)
+        except (ValueError, KeyError):
+            outcome = 'malformed'
+            self.logger.warn('Could not fetch page "%s", malformed response', title)
+        except WikipediaException:
+            outcome = 'missing'
+            self.logger.warn('Could not fetch page "%s", page does not exist', title)
+        finally:
+            metrics.observe('wiki_fetch_seconds', time.time() - time_start, outcome=outcome)
+        return title, None
+
+
 class DirectoryContentLister:
     def __init__(self, dir_path, excluded_file=None):
         self.dir_path = dir_path
@@ -454,48 +2572,893 @@ class DirectoryContentLister:
         return content_list
 
 
+class KeywordIndex:
+    """
+    Inverted index from keyword to the documents containing it, with keyword counts of every document.
+    A query touches only the postings of the master keywords and scores documents with
+    matching / sqrt(|master keywords| * |document keywords|). Keywords are lemma ids, adding a document
+    with unchanged keywords is a no-op.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.document_keywords = {}
+
+    def add_document(self, title, keywords):
+        keywords = frozenset(keywords)
+        if self.document_keywords.get(title) == keywords:
+            return
+        if title in self.document_keywords:
+            self.remove_document(title)
+        self._insert_document(title, keywords)
+
+    def _insert_document(self, title, keywords):
+        self.document_keywords[title] = keywords
+        for keyword in keywords:
+            self.postings.setdefault(keyword, set()).add(title)
+
+    def remove_document(self, title):
+        for keyword in self.document_keywords.pop(title):
+            documents = self.postings[keyword]
+            documents.discard(title)
+            if not documents:
+                del self.postings[keyword]
+
+    def query(self, master_keywords, threshold=0.0, top_k=None):
+        """
+        returns (title, score) pairs with score above threshold, best first, at most top_k of them
+        """
+        matching_counts = collections.Counter()
+        for keyword in master_keywords:
+            matching_counts.update(self.postings.get(keyword, ()))
+        return self._rank(master_keywords, matching_counts, threshold, top_k)
+
+    def _rank(self, master_keywords, matching_counts, threshold, top_k):
+        keywords_counts = dict((title, len(self.document_keywords[title])) for title in matching_counts)
+        return self.rank_matching_counts(len(master_keywords), matching_counts, keywords_counts, threshold, top_k)
+
+    @staticmethod
+    def rank_matching_counts(master_keywords_count, matching_counts, keywords_counts, threshold, top_k):
+        similarity = []
+        for title, matching_count in matching_counts.iteritems():
+            score = matching_count / math.sqrt(master_keywords_count * keywords_counts[title])
+            if score > threshold:
+                similarity.append((title, score))
+        if top_k is not None:
+            return heapq.nlargest(top_k, similarity, key=operator.itemgetter(1))
+        return sorted(similarity, key=operator.itemgetter(1), reverse=True)
+
+
+class MinHashIndex(KeywordIndex):
+    """
+    Approximate keyword index for large comparison sets. Every document keyword set gets a MinHash signature
+    of bands * rows values, the signature is cut into bands and documents sharing a whole band with the master
+    become candidates, only candidates are scored exactly as by KeywordIndex. A document of Jaccard similarity
+    s to the master is a candidate with probability 1 - (1 - s ** rows) ** bands: more bands raise recall,
+    more rows lower the number of dissimilar candidates. Keywords are hashed by their words, so signatures
+    do not depend on lemma ids of the process.
+    """
+    def __init__(self, bands=32, rows=2, seed=1):
+        KeywordIndex.__init__(self)
+        self.bands = bands
+        self.rows = rows
+        random_state = numpy.random.RandomState(seed)
+        # multiply-shift hash functions ((a * x + b) mod 2 ** 64) >> 32 with odd a
+        self.multipliers = random_state.randint(0, 2 ** 64, bands * rows, dtype=numpy.uint64) | numpy.uint64(1)
+        self.increments = random_state.randint(0, 2 ** 64, bands * rows, dtype=numpy.uint64)
+        self.keyword_hashes = {}
+        self.buckets = {}
+        self.document_bands = {}
+
+    def _insert_document(self, title, keywords):
+        self.document_keywords[title] = keywords
+        bands = self.get_bands(keywords)
+        self.document_bands[title] = bands
+        for band in bands:
+            self.buckets.setdefault(band, set()).add(title)
+
+    def remove_document(self, title):
+        del self.document_keywords[title]
+        for band in self.document_bands.pop(title):
+            documents = self.buckets[band]
+            documents.discard(title)
+            if not documents:
+                del self.buckets[band]
+
+    def query(self, master_keywords, threshold=0.0, top_k=None):
+        master_keywords = frozenset(master_keywords)
+        candidates = set()
+        for band in self.get_bands(master_keywords):
+            candidates.update(self.buckets.get(band, ()))
+        metrics.increment('lsh_candidates_total', len(candidates))
+        matching_counts = collections.Counter()
+        for title in candidates:
+            matching_count = len(master_keywords & self.document_keywords[title])
+            if matching_count:
+                matching_counts[title] = matching_count
+        return self._rank(master_keywords, matching_counts, threshold, top_k)
+
+    def get_bands(self, keywords):
+        """
+        returns (band number, band values) keys of the keywords signature, there are none for no keywords
+        """
+        if not keywords:
+            return []
+        signature = self.get_signature(keywords)
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tostring()) for band in xrange(self.bands)]
+
+    def get_signature(self, keywords):
+        hashes = numpy.fromiter((self._get_keyword_hash(keyword) for keyword in keywords), numpy.uint64,
+                                len(keywords))
+        values = numpy.outer(hashes, self.multipliers) + self.increments
+        return (values >> numpy.uint64(32)).min(axis=0)
+
+    def get_candidate_probability(self, similarity):
+        return 1.0 - (1.0 - similarity ** self.rows) ** self.bands
+
+    def _get_keyword_hash(self, keyword):
+        keyword_hash = self.keyword_hashes.get(keyword)
+        if keyword_hash is None:
+            digest = hashlib.md5(vocabulary.get_word(keyword).encode('utf-8')).digest()
+            keyword_hash = self.keyword_hashes[keyword] = struct.unpack('<Q', digest[:8])[0]
+        return keyword_hash
+
+
+def get_keyword_index(mode='exact', bands=32, rows=2):
+    if mode == 'minhash':
+        return MinHashIndex(bands, rows)
+    return KeywordIndex()
+
+
+class PersistentKeywordIndex(AbstractSqliteCache):
+    """
+    Inverted keyword index kept in a SQLite file between runs, scored as by KeywordIndex. Postings and the
+    keyword count of every document are stored as rows, so a query reads only the postings of the master
+    keywords instead of loading the whole index. Keywords are stored as words, a document is indexed again
+    only when the digest of its keywords changes.
+    """
+    max_query_keywords = 500
+
+    def __init__(self, path):
+        AbstractSqliteCache.__init__(self, path)
+
+    def synchronize(self, documents_keywords):
+        """
+        makes the index hold exactly the given title -> keyword ids documents, returns the numbers of documents
+        added or changed and of documents removed
+        """
+        documents_words = dict((self._to_text(title), sorted(self._to_text(vocabulary.get_word(keyword))
+                                                             for keyword in keywords))
+                               for title, keywords in documents_keywords.iteritems())
+        with self.lock:
+            connection = self._get_connection()
+            digests = dict(connection.execute('SELECT title, digest FROM documents'))
+            removed = [title for title in digests if title not in documents_words]
+            changed = []
+            for title, words in documents_words.iteritems():
+                digest = self._get_digest(words)
+                if digests.get(title) != digest:
+                    changed.append((title, words, digest))
+            for title in itertools.chain(removed, (title for title, _, _ in changed)):
+                connection.execute('DELETE FROM postings WHERE title = ?', (title,))
+                connection.execute('DELETE FROM documents WHERE title = ?', (title,))
+            for title, words, digest in changed:
+                connection.execute('INSERT INTO documents VALUES (?, ?, ?)', (title, len(words), digest))
+                connection.executemany('INSERT INTO postings VALUES (?, ?)', ((word, title) for word in words))
+            connection.commit()
+        return len(changed), len(removed)
+
+    def get_documents_count(self):
+        with self.lock:
+            return self._get_connection().execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def query(self, master_keywords, threshold=0.0, top_k=None):
+        """
+        returns (title, score) pairs with score above threshold, best first, at most top_k of them
+        """
+        words = sorted(set(self._to_text(vocabulary.get_word(keyword)) for keyword in master_keywords))
+        matching_counts = collections.Counter()
+        keywords_counts = {}
+        with self.lock:
+            connection = self._get_connection()
+            # keywords are queried in groups, SQLite limits the number of parameters of a statement
+            for start in xrange(0, len(words), self.max_query_keywords):
+                query_words = words[start:start + self.max_query_keywords]
+                for title, matching_count, keywords_count in connection.execute(
+                        'SELECT postings.title, COUNT(*), documents.keywords_count FROM postings JOIN documents '
+                        'ON documents.title = postings.title WHERE postings.keyword IN ({}) '
+                        'GROUP BY postings.title'.format(', '.join('?' * len(query_words))), query_words):
+                    matching_counts[title] += matching_count
+                    keywords_counts[title] = keywords_count
+        return KeywordIndex.rank_matching_counts(len(words), matching_counts, keywords_counts, threshold, top_k)
+
+    @staticmethod
+    def _to_text(value):
+        return value.decode('utf-8') if isinstance(value, str) else value
+
+    @staticmethod
+    def _get_digest(words):
+        return hashlib.sha1('\0'.join(words).encode('utf-8')).hexdigest()
+
+    def _create_schema(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS documents (title TEXT PRIMARY KEY, '
+                           'keywords_count INTEGER NOT NULL, digest TEXT NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS postings (keyword TEXT NOT NULL, title TEXT NOT NULL, '
+                           'PRIMARY KEY (keyword, title))')
+        connection.execute('CREATE INDEX IF NOT EXISTS postings_title ON postings (title)')
+
+
 class DocumentKeyphrasesComparator:
-    def __init__(self, master_keyphrases, comparison_keyphrases_map, threshold=0.45):
+    def __init__(self, master_keyphrases, comparison_keyphrases_map, threshold=0.45, top_k=None, index=None):
         self.master_keyphrases = master_keyphrases
         self.comparison_keyphrases_map = comparison_keyphrases_map
         self.logger = get_logger("DocumentKeyphrasesComparator")
         self.threshold = threshold
+        self.top_k = top_k
+        self.index = index if index is not None else KeywordIndex()
 
     def compare(self):
         master_words = self._extract_words(self.master_keyphrases)
+        for title, cmp_keyphrases in self.comparison_keyphrases_map.iteritems():
+            self.index.add_document(title, self._extract_words(cmp_keyphrases))
         self.logger.info('Starting document comparison...')
-        document_similarity = self._check_similarity_with_keyphrases_map(master_words)
+        with metrics.time('stage_duration_seconds', stage='compare'):
+            document_similarity = self.index.query(master_words, self.threshold, self.top_k)
         self.logger.info('Document comparison finished')
         return document_similarity
 
-    def _check_similarity_with_keyphrases_map(self, master_words):
-        similarity = {}
-        for title, cmp_keyphrases in self.comparison_keyphrases_map.iteritems():
-            matching_part = self._count_matching_part(cmp_keyphrases, master_words)
-            similarity[title] = matching_part
-        similarity = sorted(similarity.items(), key=operator.itemgetter(1), reverse=True)
-        top = filter(lambda x: x[1] > self.threshold, similarity)
-        return top
-
-    def _count_matching_part(self, cmp_keyphrases, master_words):
-        cmp_words = self._extract_words(cmp_keyphrases)
-        matching_count = len(master_words.intersection(cmp_words))
-        divider = math.sqrt(len(master_words) * len(cmp_words))
-        if divider == 0:
-            return 0
-        return matching_count / divider
-
     @staticmethod
     def _extract_words(phrases):
         words_set = set()
         for phrase in phrases:
-            words = phrase[0].split()
-            for w in words:
-                words_set.add(w)
+            words_set.update(phrase[0])
         return words_set
 
 
+class DocumentSimilarityMatrix:
+    """
+    All-pairs similarity of documents, scored as by KeywordIndex. Keyword sets of the documents form a sparse
+    binary document x keyword matrix, its product with its own transpose holds the keyword overlaps of every
+    pair, scaled to scores by the keyword counts. The product is computed for blocks of block_size rows, so
+    memory is bounded by a block of overlaps instead of the whole similarity matrix.
+    """
+    def __init__(self, keyphrases_map):
+        self.titles = sorted(keyphrases_map)
+        self.logger = get_logger('DocumentSimilarityMatrix')
+        keyword_columns = {}
+        columns = array.array('I')
+        counts = []
+        for title in self.titles:
+            keywords = DocumentKeyphrasesComparator._extract_words(keyphrases_map[title])
+            columns.extend(keyword_columns.setdefault(keyword, len(keyword_columns)) for keyword in keywords)
+            counts.append(len(keywords))
+        self.counts = numpy.array(counts, dtype=numpy.int64)
+        indices = numpy.frombuffer(columns, dtype=numpy.uint32).astype(numpy.int32)
+        indptr = numpy.concatenate(([0], numpy.cumsum(self.counts)))
+        self.matrix = scipy.sparse.csr_matrix((numpy.ones(len(indices)), indices, indptr),
+                                              shape=(len(self.titles), len(keyword_columns)))
+
+    def get_neighbours(self, top_k=None, threshold=0.0, block_size=None):
+        """
+        yields (title, neighbours) of every document, neighbours are (title, score) pairs with score above
+        threshold, best first, at most top_k of them; by default the whole matrix is a single block
+        """
+        transposed = self.matrix.transpose().tocsr()
+        block_size = max(block_size or len(self.titles), 1)
+        for start in xrange(0, len(self.titles), block_size):
+            with metrics.time('stage_duration_seconds', stage='compare'):
+                block = (self.matrix[start:start + block_size] * transposed).tocsr()
+            self.logger.debug('Computed similarity of documents %d-%d, %d scores', start,
+                              start + block.shape[0] - 1, block.nnz)
+            for offset in xrange(block.shape[0]):
+                row = start + offset
+                row_columns = block.indices[block.indptr[offset]:block.indptr[offset + 1]]
+                matching_counts = block.data[block.indptr[offset]:block.indptr[offset + 1]]
+                # same expression as KeywordIndex, so both score a pair identically
+                row_scores = matching_counts / numpy.sqrt((self.counts[row] * self.counts[row_columns]).astype(float))
+                kept = (row_columns != row) & (row_scores > threshold)
+                row_columns, row_scores = row_columns[kept], row_scores[kept]
+                # best scores first, ties in the order of titles
+                order = numpy.lexsort((row_columns, -row_scores))[:top_k]
+                yield self.titles[row], [(self.titles[column], score) for column, score in itertools.izip(
+                    row_columns[order].tolist(), row_scores[order].tolist())]
+
+    def write_neighbours(self, path, top_k=None, threshold=0.0, block_size=None):
+        """
+        writes one JSON object of title and neighbours per line, returns the number of documents
+        """
+        documents_count = 0
+        with open(path, 'w') as f:
+            for title, neighbours in self.get_neighbours(top_k, threshold, block_size):
+                f.write(json.dumps({'title': title, 'neighbours': [list(neighbour) for neighbour in neighbours]}))
+                f.write('\n')
+                documents_count += 1
+        return documents_count
+
+
+class ServiceRequestException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+class KeyphraseService:
+    """
+    Extraction pipeline kept warm between requests of the HTTP server. NLP models are loaded once at start,
+    documents of a single request are extracted in one batch and requests are serialized, because the
+    shared vocabulary and lemma cache are not thread-safe. Lemmas of every request are interned into the
+    shared vocabulary, it is cleared between requests once it holds more than max_vocabulary_size of them,
+    so arbitrary input does not grow it without bound
+    """
+    def __init__(self, ranking_engine=None, result_cache=None, batch_sentences=2000, max_vocabulary_size=500000):
+        self.ranking_engine = ranking_engine or SparseRankingEngine()
+        self.result_cache = result_cache
+        self.batch_sentences = batch_sentences
+        self.max_vocabulary_size = max_vocabulary_size
+        self.lock = threading.RLock()
+        self.started_at = time.time()
+        self.logger = get_logger('KeyphraseService')
+
+    def load(self):
+        load_nlp_models()
+
+    def handle(self, handler, request):
+        """
+        runs handler(request) holding the service lock, lemma ids of keyphrases extracted by the handler are
+        valid until it returns
+        """
+        with self.lock:
+            try:
+                return handler(request)
+            finally:
+                if len(vocabulary) > self.max_vocabulary_size:
+                    self.logger.info('Clearing vocabulary of {} lemmas'.format(len(vocabulary)))
+                    vocabulary.clear()
+
+    def extract(self, texts):
+        """
+        returns normalized keyphrases of every text, in order
+        """
+        providers = [TextContentProvider(str(index), text) for index, text in enumerate(texts)]
+        with self.lock:
+            with metrics.time('service_extraction_seconds'):
+                extractor = BatchKeyphraseExtractor(providers, self.ranking_engine, self.result_cache,
+                                                    self.batch_sentences)
+                keyphrases_map = extractor.extract_keyphrases_map_by_textrank()
+        return [keyphrases_map[provider.get_title()] for provider in providers]
+
+    @staticmethod
+    def count_request(endpoint, failed=False):
+        metrics.increment('http_requests_total', endpoint=endpoint)
+        if failed:
+            metrics.increment('http_request_errors_total', endpoint=endpoint)
+
+    def get_health(self):
+        return {'status': 'ok', 'models_loaded': nlp_models.tagger is not None,
+                'uptime_seconds': time.time() - self.started_at}
+
+    def update_metrics(self):
+        metrics.set_gauge('uptime_seconds', time.time() - self.started_at)
+        update_process_gauges()
+
+
+class KeyphraseRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON API of the keyphrase service. POST endpoints accept a JSON object or raw text, in which case the
+    parameters are taken from the query string. Documents are given either as a single "text" or as a list of
+    "documents", each one a string or a {"title": ..., "text": ...} object, all of them extracted in one batch.
+
+    POST /extract      -> {"documents": [{"title": ..., "keyphrases": [[phrase, weight], ...]}, ...]}
+    POST /clusterize   -> {"documents": [{"title": ..., "clusters": {name: [phrase, ...]}}, ...]}, "mode" is
+                          token or similarity, with the minimum "similarity" of linked phrases
+    POST /similarity   -> {"similarity": [[title, score], ...]}, of "documents" to the "master" text
+    GET /health, GET /metrics (?format=prometheus for the Prometheus text format)
+    """
+    server_version = 'IWI-AKE'
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, service.get_health())
+        elif path == '/metrics':
+            service.update_metrics()
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            if query.get('format') == ['prometheus']:
+                self._send(200, metrics.to_prometheus(), 'text/plain; version=0.0.4')
+            else:
+                self._send_json(200, metrics.to_json())
+        else:
+            self._send_json(404, {'error': 'Unknown endpoint "{}"'.format(path)})
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        handlers = {
+            '/extract': self._extract,
+            '/clusterize': self._clusterize,
+            '/similarity': self._similarity
+        }
+        if path not in handlers:
+            self._send_json(404, {'error': 'Unknown endpoint "{}"'.format(path)})
+            return
+        try:
+            response = service.handle(handlers[path], self._read_request())
+        except ServiceRequestException as e:
+            service.count_request(path, failed=True)
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            service.logger.exception('Request to "{}" failed'.format(path))
+            service.count_request(path, failed=True)
+            self._send_json(500, {'error': 'Internal error: {}'.format(e.__class__.__name__)})
+            return
+        service.count_request(path)
+        self._send_json(200, response)
+
+    def log_message(self, format, *args):
+        logger = self.server.service.logger
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s - %s', self.address_string(), format % args)
+
+    def _extract(self, request):
+        titles, texts = self._get_documents(request)
+        top = self._get_float(request, 'top', 0.2)
+        documents = []
+        for title, keyphrases in itertools.izip(titles, self.server.service.extract(texts)):
+            top_keyphrases = KeyphraseExtractor.get_top_keyphrases(keyphrases, top)
+            documents.append({'title': title, 'keyphrases': [[vocabulary.get_phrase(phrase), weight]
+                                                             for phrase, weight in top_keyphrases]})
+        return {'documents': documents}
+
+    def _clusterize(self, request):
+        titles, texts = self._get_documents(request)
+        top = self._get_float(request, 'top', 0.2)
+        mode = request.get('mode', 'token')
+        if mode not in CLUSTER_MODES:
+            raise ServiceRequestException('"mode" must be one of {}'.format(', '.join(CLUSTER_MODES)))
+        similarity = self._get_float(request, 'similarity', 0.5)
+        documents = []
+        for title, keyphrases in itertools.izip(titles, self.server.service.extract(texts)):
+            clusters = KeyphraseExtractor.clusterize(KeyphraseExtractor.get_top_keyphrases(keyphrases, top), mode,
+                                                     similarity)
+            documents.append({'title': title, 'clusters': dict(
+                (KeyphraseExtractor.get_cluster_name(cluster), [vocabulary.get_phrase(phrase) for phrase in phrases])
+                for cluster, phrases in clusters.iteritems())})
+        return {'documents': documents}
+
+    def _similarity(self, request):
+        master = request.get('master')
+        if isinstance(master, dict):
+            master = master.get('text')
+        if not isinstance(master, basestring):
+            raise ServiceRequestException('"master" text is required')
+        titles, texts = self._get_documents(request)
+        threshold = self._get_float(request, 'threshold', 0.45)
+        top_k = self._get_positive_int(request, 'top_k', None)
+        mode = request.get('mode', 'exact')
+        if mode not in SIMILARITY_MODES:
+            raise ServiceRequestException('"mode" must be one of {}'.format(', '.join(SIMILARITY_MODES)))
+        bands = self._get_positive_int(request, 'bands', 32)
+        rows = self._get_positive_int(request, 'rows', 2)
+        keyphrases = [KeyphraseExtractor.get_top_keyphrases(document_keyphrases, 0.2)
+                      for document_keyphrases in self.server.service.extract([master] + texts)]
+        comparison_keyphrases_map = dict(itertools.izip(titles, keyphrases[1:]))
+        similarity = DocumentKeyphrasesComparator(keyphrases[0], comparison_keyphrases_map, threshold, top_k,
+                                                  get_keyword_index(mode, bands, rows)).compare()
+        return {'similarity': [[title, score] for title, score in similarity]}
+
+    def _read_request(self):
+        try:
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        except ValueError:
+            raise ServiceRequestException('Invalid Content-Length')
+        content_type = self.headers.getheader('Content-Type', '').split(';')[0].strip()
+        if content_type == 'application/json':
+            try:
+                request = json.loads(body)
+            except ValueError:
+                raise ServiceRequestException('Malformed JSON')
+            if not isinstance(request, dict):
+                raise ServiceRequestException('JSON object expected')
+            return request
+        request = dict((name, values[-1]) for name, values in
+                       urlparse.parse_qs(urlparse.urlparse(self.path).query).iteritems())
+        request['text'] = body
+        return request
+
+    @staticmethod
+    def _get_documents(request):
+        """
+        returns titles and texts of the request documents
+        """
+        if 'documents' in request:
+            documents = request['documents']
+            if not isinstance(documents, list):
+                raise ServiceRequestException('"documents" must be a list')
+        elif 'text' in request:
+            documents = [request['text']]
+        else:
+            raise ServiceRequestException('"text" or "documents" is required')
+        titles, texts = [], []
+        unique_titles = set()
+        for index, document in enumerate(documents):
+            if isinstance(document, dict):
+                title, text = document.get('title', str(index)), document.get('text')
+            else:
+                title, text = str(index), document
+            if not isinstance(text, basestring):
+                raise ServiceRequestException('Text of document {} is missing'.format(index))
+            if not isinstance(title, basestring):
+                raise ServiceRequestException('Title of document {} must be a string'.format(index))
+            if title in unique_titles:
+                raise ServiceRequestException('Title "{}" of document {} is not unique'.format(title, index))
+            unique_titles.add(title)
+            titles.append(title)
+            texts.append(text)
+        return titles, texts
+
+    @staticmethod
+    def _get_float(request, name, default):
+        value = request.get(name, default)
+        if isinstance(value, bool):
+            raise ServiceRequestException('"{}" must be a number'.format(name))
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ServiceRequestException('"{}" must be a number'.format(name))
+
+    @staticmethod
+    def _get_positive_int(request, name, default):
+        value = request.get(name, default)
+        if value is None:
+            return value
+        # bool is a subclass of int, but true is not a count
+        if isinstance(value, bool) or not isinstance(value, (int, long)) or value < 1:
+            raise ServiceRequestException('"{}" must be a positive integer'.format(name))
+        return value
+
+    def _send_json(self, status, response):
+        self._send(status, json.dumps(response), 'application/json')
+
+    def _send(self, status, body, content_type):
+        body = body.encode('utf-8') if isinstance(body, unicode) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class KeyphraseServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, KeyphraseRequestHandler)
+        self.service = service
+
+
+class SyntheticCorpus:
+    """
+    Reproducible synthetic text of any size: a random walk over the word successors of the given texts,
+    split into sentences of 8 to 25 words, seeded so the same size and seed always give the same text
+    """
+    def __init__(self, texts, seed=0):
+        self.seed = seed
+        self.successors = collections.defaultdict(list)
+        for text in texts:
+            words = [word.strip('.') for word in text.split() if word.strip('.')]
+            for word, successor in itertools.izip(words, words[1:]):
+                self.successors[word].append(successor)
+        self.words = sorted(self.successors)
+
+    def generate(self, size):
+        rng = random.Random('{}-{}'.format(self.seed, size))
+        sentences = []
+        length = 0
+        word = rng.choice(self.words)
+        while length < size:
+            sentence_words = []
+            for _ in xrange(rng.randint(8, 25)):
+                sentence_words.append(word)
+                word = rng.choice(self.successors.get(word) or self.words)
+            sentence = ' '.join(sentence_words)
+            sentence = sentence[:1].upper() + sentence[1:] + '.'
+            sentences.append(sentence)
+            length += len(sentence) + 1
+        return ' '.join(sentences)[:size]
+
+
+class PeakMemorySampler(threading.Thread):
+    """
+    Samples resident memory of the process every interval seconds until stopped and keeps the highest sample.
+    Where the current resident memory cannot be read, the peak of the whole process is taken instead.
+    """
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak_rss_mb = PipelineBenchmark._get_rss_mb()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, PipelineBenchmark._get_rss_mb())
+
+    def stop(self):
+        """
+        returns the peak resident memory in MB
+        """
+        self.stopped.set()
+        self.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, PipelineBenchmark._get_rss_mb())
+        return self.peak_rss_mb
+
+
+class PipelineBenchmark:
+    """
+    Runs the extraction pipeline stage by stage on synthetic corpora of the given sizes and on the bundled
+    texts and reports wall time and peak resident memory of every stage as JSON. Stages call the same methods
+    as KeyphraseExtractor._analyze_sentences and the rest of the pipeline, in the same order, so sentences go
+    through the sentence cache and are tagged in one batch. Every corpus is measured in a fresh worker process
+    with NLP models already loaded, so memory of a corpus does not depend on the corpora measured before it.
+    """
+    stages = ['sentence_split', 'sentence_cache', 'tokenize', 'tag', 'lemmatize', 'lemma_ids', 'candidate_filter',
+              'graph_build', 'pagerank', 'merge', 'normalize', 'clusterize', 'compare']
+
+    def __init__(self, configuration):
+        self.sizes = [self.parse_size(size) for size in configuration.sizes.split(',') if size]
+        self.seed = configuration.seed
+        self.ranking = configuration.ranking
+        self.texts_dir = configuration.texts
+        self.output = configuration.output
+        self.logger = get_logger('PipelineBenchmark')
+
+    @staticmethod
+    def parse_size(size):
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        size = size.strip().upper().rstrip('B')
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+
+    def run(self):
+        text_paths = []
+        if self.texts_dir is not None and os.path.isdir(self.texts_dir):
+            text_paths = sorted(DirectoryContentLister(self.texts_dir).get_content_list())
+        tasks = [('synthetic-{}'.format(size), None, size, text_paths, self.seed, self.ranking)
+                 for size in self.sizes]
+        tasks += [(path, path, None, text_paths, self.seed, self.ranking) for path in text_paths]
+        results = {
+            'commit': self._get_commit(),
+            'python': sys.version.split()[0],
+            'ranking': self.ranking,
+            'seed': self.seed,
+            'stages': self.stages,
+            'corpora': []
+        }
+        for task in tasks:
+            self.logger.info('Benchmarking corpus "{}"...'.format(task[0]))
+            # a new process for every corpus keeps peak memory of the corpora independent
+            pool = multiprocessing.Pool(1, initializer=load_nlp_models)
+            try:
+                results['corpora'].append(pool.apply(benchmark_corpus, (task,)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            self.logger.info('Corpus "{}" done in {:.3f} seconds'.format(task[0],
+                                                                         results['corpora'][-1]['total_seconds']))
+        report = json.dumps(results, indent=2, sort_keys=True)
+        if self.output is None:
+            print(report)
+        else:
+            with open(self.output, 'w') as f:
+                f.write(report)
+            self.logger.info('Wrote benchmark results to "{}"'.format(self.output))
+        return 0
+
+    @staticmethod
+    def measure_corpus(name, path, size, text_paths, seed, ranking):
+        texts = [FileContentProvider(text_path).get_content() for text_path in text_paths]
+        if path is not None:
+            text = FileContentProvider(path).get_content()
+        else:
+            text = SyntheticCorpus(texts or [string.ascii_lowercase], seed).generate(size)
+        comparison_keyphrases_map = {}
+        for title, keyphrases in extract_batch_top_keyphrases(
+                ([TextContentProvider(text_path, comparison_text)
+                  for text_path, comparison_text in itertools.izip(text_paths, texts)],
+                 RANKING_ENGINES[ranking](), None)):
+            comparison_keyphrases_map[title] = keyphrases
+        # the corpus is measured as in a first run, not with the sentences of the comparison texts cached
+        lemma_cache.clear()
+        sentence_cache.clear()
+
+        extractor = KeyphraseExtractor(None, RANKING_ENGINES[ranking]())
+        engine = extractor.ranking_engine
+        measure = PipelineBenchmark._measure
+        stages = {}
+        sentences = measure(stages, 'sentence_split', extractor._split_sentences, text)
+        analyzed_sentences, missing = measure(stages, 'sentence_cache', extractor._get_cached_sentences, sentences)
+        tokenized_sentences = measure(stages, 'tokenize', extractor._tokenize_words, missing)
+        tagged_sentences = measure(stages, 'tag', extractor._tag_sentences, tokenized_sentences)
+        measure(stages, 'lemmatize', lambda: extractor._cache_sentences(
+            analyzed_sentences, missing, extractor._lemmatize_sentences(tagged_sentences)))
+        tokens = measure(stages, 'lemma_ids', extractor._get_tokens, analyzed_sentences)
+        words, candidates = measure(stages, 'candidate_filter', lambda: (
+            extractor._get_words(tokens), extractor._get_candidate_words(tokens, extractor.good_tags)))
+
+        def build_graph():
+            graph = engine.create_graph()
+            engine.add_candidates(graph, candidates)
+            return graph
+
+        def merge():
+            merged = extractor._merge_keywords_into_keyphrases(set(word_ranks), word_ranks, words,
+                                                               extractor.keyphrase_window)
+            return sorted(merged.items(), key=operator.itemgetter(1), reverse=True)
+
+        graph = measure(stages, 'graph_build', build_graph)
+        word_ranks = measure(stages, 'pagerank', lambda: extractor._select_top_word_ranks(engine.rank_graph(graph)))
+        keyphrases = measure(stages, 'merge', merge)
+        keyphrases = measure(stages, 'normalize', lambda: extractor._normalize_weights(keyphrases) if keyphrases
+                             else keyphrases)
+        top_keyphrases = extractor.get_top_keyphrases(keyphrases, 0.2)
+        measure(stages, 'clusterize', extractor.clusterize, top_keyphrases)
+        measure(stages, 'compare', lambda: DocumentKeyphrasesComparator(top_keyphrases,
+                                                                        comparison_keyphrases_map).compare())
+        return {
+            'name': name,
+            'bytes': len(text),
+            'sentences': len(sentences),
+            'tokens': len(tokens),
+            'candidates': len(candidates),
+            'keywords': len(word_ranks),
+            'keyphrases': len(keyphrases),
+            'total_seconds': sum(stage['seconds'] for stage in stages.itervalues()),
+            'stages': stages
+        }
+
+    @staticmethod
+    def _measure(stages, stage, function, *args):
+        """
+        peak_rss_mb is the highest resident memory sampled while the stage ran, rss_growth_mb the memory the
+        stage kept after it finished
+        """
+        rss_start = PipelineBenchmark._get_rss_mb()
+        sampler = PeakMemorySampler()
+        sampler.start()
+        time_start = time.time()
+        try:
+            result = function(*args)
+        finally:
+            seconds = time.time() - time_start
+            peak_rss = sampler.stop()
+        stages[stage] = {
+            'seconds': seconds,
+            'peak_rss_mb': peak_rss,
+            'rss_growth_mb': PipelineBenchmark._get_rss_mb() - rss_start
+        }
+        return result
+
+    @staticmethod
+    def _get_rss_mb():
+        """
+        current resident memory, read from /proc where available, the peak one elsewhere
+        """
+        try:
+            with open('/proc/self/statm') as f:
+                resident_pages = int(f.read().split()[1])
+        except (IOError, IndexError, ValueError):
+            return PipelineBenchmark._get_peak_rss_mb()
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+    @staticmethod
+    def _get_peak_rss_mb():
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak_rss / 1024.0
+
+    @staticmethod
+    def _get_commit():
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                               cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+def benchmark_corpus(task):
+    """
+    Benchmarks a single corpus, module level so that it can be run by a process pool worker
+    """
+    return PipelineBenchmark.measure_corpus(*task)
+
+
+class StartupBenchmark:
+    """
+    Measures in fresh interpreters the time of importing this module and of running commands that need no
+    dependencies, and checks that importing it loads none of the lazily imported modules. Any such module or
+    a median import time over max_import_seconds is reported as a regression with a non-zero exit code.
+    """
+    import_script = ('import sys, time, json\n'
+                     'time_start = time.time()\n'
+                     'import AKE\n'
+                     'seconds = time.time() - time_start\n'
+                     'loaded = [module.module_name for module in AKE.LAZY_MODULES\n'
+                     '          if module.module_name in sys.modules]\n'
+                     'print(json.dumps({"seconds": seconds, "loaded": loaded}))\n')
+    commands = [
+        ('help', ['--help']),
+        ('preprocess_help', ['preprocess', '--help']),
+        ('serve_help', ['serve', '--help'])
+    ]
+
+    def __init__(self, configuration):
+        self.repeat = configuration.repeat
+        self.max_import_seconds = configuration.max_import_seconds
+        self.output = configuration.output
+        self.logger = get_logger('StartupBenchmark')
+        self.module_path = os.path.abspath(__file__).replace('.pyc', '.py')
+
+    def run(self):
+        results = {'python': sys.version.split()[0], 'repeat': self.repeat, 'import': self._measure_import(),
+                   'commands': {}}
+        for name, args in self.commands:
+            results['commands'][name] = self._measure_command([sys.executable, self.module_path] + args)
+        regressions = self._get_regressions(results)
+        results['regressions'] = regressions
+        report = json.dumps(results, indent=2, sort_keys=True)
+        if self.output is None:
+            print(report)
+        else:
+            with open(self.output, 'w') as f:
+                f.write(report)
+            self.logger.info('Wrote startup benchmark to "{}"'.format(self.output))
+        for regression in regressions:
+            self.logger.error(regression)
+        return 1 if regressions else 0
+
+    def _measure_import(self):
+        timings = []
+        loaded = set()
+        for _ in xrange(self.repeat):
+            process = subprocess.Popen([sys.executable, '-c', self.import_script], stdout=subprocess.PIPE,
+                                       cwd=os.path.dirname(self.module_path))
+            output, _ = process.communicate()
+            measurement = json.loads(output.splitlines()[-1])
+            timings.append(measurement['seconds'])
+            loaded.update(measurement['loaded'])
+        return dict(self._get_summary(timings), loaded_modules=sorted(loaded))
+
+    def _measure_command(self, command):
+        timings = []
+        with open(os.devnull, 'w') as devnull:
+            for _ in xrange(self.repeat):
+                time_start = time.time()
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+                timings.append(time.time() - time_start)
+        return self._get_summary(timings)
+
+    def _get_regressions(self, results):
+        regressions = []
+        if results['import']['loaded_modules']:
+            regressions.append('Importing the module loads {}'.format(', '.join(results['import']['loaded_modules'])))
+        if self.max_import_seconds is not None and results['import']['median_seconds'] > self.max_import_seconds:
+            regressions.append('Median import time {:.3f} s exceeds {:.3f} s'.format(
+                results['import']['median_seconds'], self.max_import_seconds))
+        return regressions
+
+    @staticmethod
+    def _get_summary(timings):
+        timings = sorted(timings)
+        return {'min_seconds': timings[0], 'median_seconds': timings[len(timings) // 2], 'max_seconds': timings[-1]}
+
+
 loggers = {}
+log_level = logging.DEBUG
 
 
 def get_logger(name):
@@ -504,7 +3467,7 @@ def get_logger(name):
         return loggers.get(name)
     else:
         logger = logging.getLogger(name)
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(log_level)
         ch = logging.StreamHandler()
         ch.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -514,26 +3477,205 @@ def get_logger(name):
         return logger
 
 
+def set_log_level(level):
+    """
+    messages below the level are dropped before they are formatted, by loggers created so far and later
+    """
+    global log_level
+    log_level = level
+    for logger in loggers.itervalues():
+        logger.setLevel(level)
+
+
+def update_process_gauges():
+    metrics.set_gauge('vocabulary_size', len(vocabulary))
+    for name, value in lemma_cache.get_stats().iteritems():
+        metrics.set_gauge('lemma_cache_' + name, value)
+    for name, value in sentence_cache.get_stats().iteritems():
+        metrics.set_gauge('sentence_cache_' + name, value)
+
+
+def write_metrics(path, metrics_format):
+    update_process_gauges()
+    with open(path, 'w') as f:
+        if metrics_format == 'prometheus':
+            f.write(metrics.to_prometheus())
+        else:
+            f.write(json.dumps(metrics.to_json(), indent=2, sort_keys=True))
+
+
 def set_system_encoding():
     reload(sys)
     sys.setdefaultencoding('utf-8')
 
 
-def parse_args():
+def parse_args(args=None):
     parser = argparse.ArgumentParser(description='Extract keyphrases from provided source of text')
-    parser.add_argument('src', choices=['wiki', 'file', 'dir'], help='source of text')
-    parser.add_argument('path', help='title of coma-separated Wikipedia articles/path to file/path to directory',
-                        type=str)
+    parser.add_argument('src', choices=['wiki', 'file', 'dir', 'corpus'],
+                        help='source of text, corpus is a file written by the preprocess command')
+    parser.add_argument('path', help='title of coma-separated Wikipedia articles/path to file/path to directory/path \
+                        to preprocessed corpus', type=str)
     parser.add_argument('--master',
                         help='find linked wiki articles or files located in the file\'s directory (depending on source \
                         option) that are similar to the master article or file. This option might take a long period \
                         of time for wiki articles. dir option is not supported.', action='store_true')
-    return parser.parse_args()
+    parser.add_argument('--ranking', choices=sorted(RANKING_ENGINES.keys()), default='sparse',
+                        help='TextRank backend, networkx is kept as the reference implementation')
+    parser.add_argument('--workers', help='number of processes extracting keyphrases of compared sources in parallel \
+                        (master option only)', type=int, default=1)
+    parser.add_argument('--shard-workers', help='number of processes tokenizing and tagging shards of the master \
+                        source in parallel, results are the same as in a single process', type=int, default=1)
+    parser.add_argument('--shard-sentences', help='number of sentences in a shard (shard workers option only)',
+                        type=int, default=2000)
+    parser.add_argument('--fetch-concurrency', help='maximum number of linked wiki pages fetched at the same time \
+                        (master option only)', type=int, default=8)
+    parser.add_argument('--fetch-timeout', help='timeout of a single wiki page request in seconds', type=float,
+                        default=10)
+    parser.add_argument('--cache-dir', help='directory of persistent caches, caching is disabled when not set',
+                        type=str, default=None)
+    parser.add_argument('--wiki-cache-ttl', help='hours after which cached wiki pages are fetched again', type=float,
+                        default=24)
+    parser.add_argument('--wiki-cache-size', help='maximum size of cached wiki pages in megabytes', type=float,
+                        default=256)
+    parser.add_argument('--offline', help='get wiki pages only from the cache, requires cache directory',
+                        action='store_true')
+    parser.add_argument('--corpus-state', help='file keeping the corpus graph of a directory between runs, only \
+                        added, changed and removed files are processed again (dir source only)', type=str,
+                        default=None)
+    parser.add_argument('--keyword-index', help='SQLite file keeping the inverted keyword index of the compared \
+                        documents between runs, only changed documents are indexed again and the ones no longer \
+                        compared are dropped (master option and exact similarity mode only)',
+                        type=str, default=None)
+    parser.add_argument('--top-k', help='report at most this many most similar documents (master and all pairs \
+                        options only)', type=int, default=None)
+    parser.add_argument('--similarity-mode', choices=SIMILARITY_MODES, default='exact', help='exact scores every \
+                        compared document, minhash scores only candidates found by locality-sensitive hashing of \
+                        keyword sets (master option only)')
+    parser.add_argument('--similarity-threshold', help='minimum similarity of reported documents (master and all \
+                        pairs options only)', type=float, default=0.45)
+    parser.add_argument('--all-pairs', help='file to write the most similar documents of every document of the \
+                        directory or preprocessed corpus to, as JSON lines (dir and corpus sources only)', type=str,
+                        default=None)
+    parser.add_argument('--block-size', help='number of documents whose similarity to all the others is computed \
+                        at once, all documents by default (all pairs option only)', type=int, default=None)
+    parser.add_argument('--lsh-bands', help='number of MinHash signature bands, more bands find more similar \
+                        documents (minhash similarity mode only)', type=int, default=32)
+    parser.add_argument('--lsh-rows', help='number of MinHash values in a band, more rows make fewer dissimilar \
+                        candidates (minhash similarity mode only)', type=int, default=2)
+    parser.add_argument('--lemma-cache-size', help='maximum number of lemmas memoized across all extracted documents',
+                        type=int, default=100000)
+    parser.add_argument('--sentence-cache-size', help='maximum number of analyzed sentences memoized across all \
+                        extracted documents, 0 disables the cache', type=int, default=10000)
+    parser.add_argument('--document', help='extract keyphrases of this document only, with master option it is \
+                        compared to the other documents (corpus source only)', type=str, default=None)
+    parser.add_argument('--cluster-mode', choices=CLUSTER_MODES, default='token', help='token groups phrases by \
+                        every lemma they contain, similarity merges phrases with similar lemma sets')
+    parser.add_argument('--cluster-similarity', help='minimum Jaccard similarity of lemma sets of linked phrases \
+                        (similarity cluster mode only)', type=float, default=0.5)
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='DEBUG', help='messages below this level are not \
+                        formatted nor shown')
+    parser.add_argument('--metrics', help='file to write counters and stage duration histograms of the run to',
+                        type=str, default=None)
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                        help='format of the metrics file')
+    return parser.parse_args(args)
+
+
+def parse_preprocess_args(args):
+    parser = argparse.ArgumentParser(prog='AKE.py preprocess',
+                                     description='Analyze text once and write it into a preprocessed corpus file')
+    parser.add_argument('path', help='path to file/path to directory', type=str)
+    parser.add_argument('output', help='path of the preprocessed corpus file', type=str)
+    parser.add_argument('--lemma-cache-size', help='maximum number of lemmas memoized across all analyzed documents',
+                        type=int, default=100000)
+    parser.add_argument('--sentence-cache-size', help='maximum number of analyzed sentences memoized across all \
+                        analyzed documents, 0 disables the cache', type=int, default=10000)
+    return parser.parse_args(args)
+
+
+def parse_serve_args(args):
+    parser = argparse.ArgumentParser(prog='AKE.py serve',
+                                     description='Serve keyphrase extraction, clustering and similarity over HTTP')
+    parser.add_argument('--host', help='address to listen on', type=str, default='127.0.0.1')
+    parser.add_argument('--port', help='port to listen on', type=int, default=8080)
+    parser.add_argument('--ranking', choices=sorted(RANKING_ENGINES.keys()), default='sparse',
+                        help='TextRank backend, networkx is kept as the reference implementation')
+    parser.add_argument('--cache-dir', help='directory of persistent caches, caching is disabled when not set',
+                        type=str, default=None)
+    parser.add_argument('--batch-sentences', help='minimum number of sentences tagged together', type=int,
+                        default=2000)
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='DEBUG', help='messages below this level are not \
+                        formatted nor shown')
+    parser.add_argument('--lemma-cache-size', help='maximum number of lemmas memoized across all extracted documents',
+                        type=int, default=100000)
+    parser.add_argument('--sentence-cache-size', help='maximum number of analyzed sentences memoized across all \
+                        extracted documents, 0 disables the cache', type=int, default=10000)
+    parser.add_argument('--vocabulary-size', help='number of interned lemmas above which the vocabulary is cleared \
+                        after a request', type=int, default=500000)
+    return parser.parse_args(args)
+
+
+def parse_bench_args(args):
+    parser = argparse.ArgumentParser(prog='AKE.py bench',
+                                     description='Measure wall time and peak memory of every extraction stage')
+    parser.add_argument('--sizes', help='comma-separated sizes of synthetic corpora, K and M suffixes are supported',
+                        type=str, default='1K,10K,100K,1M,10M,100M')
+    parser.add_argument('--seed', help='seed of the synthetic corpora', type=int, default=0)
+    parser.add_argument('--texts', help='directory of texts benchmarked as they are and used to generate the \
+                        synthetic corpora', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                            'res'))
+    parser.add_argument('--ranking', choices=sorted(RANKING_ENGINES.keys()), default='sparse',
+                        help='TextRank backend, networkx is kept as the reference implementation')
+    parser.add_argument('--output', help='JSON results file, printed when not set', type=str, default=None)
+    return parser.parse_args(args)
+
+
+def parse_startup_bench_args(args):
+    parser = argparse.ArgumentParser(prog='AKE.py startup-bench',
+                                     description='Measure import and startup time, fail on startup regressions')
+    parser.add_argument('--repeat', help='number of measured runs of every command', type=int, default=5)
+    parser.add_argument('--max-import-seconds', help='fail when the median import time exceeds this limit',
+                        type=float, default=None)
+    parser.add_argument('--output', help='JSON report file, printed when not set', type=str, default=None)
+    return parser.parse_args(args)
+
+
+def serve(configuration):
+    set_log_level(getattr(logging, configuration.log_level))
+    logger = get_logger('KeyphraseServer')
+    lemma_cache.resize(configuration.lemma_cache_size)
+    sentence_cache.resize(configuration.sentence_cache_size)
+    result_cache = None
+    if configuration.cache_dir is not None:
+        result_cache = KeyphraseResultCache(os.path.join(configuration.cache_dir, 'keyphrases.sqlite'))
+    service = KeyphraseService(RANKING_ENGINES[configuration.ranking](), result_cache,
+                               configuration.batch_sentences, configuration.vocabulary_size)
+    logger.info('Loading NLP models...')
+    service.load()
+    server = KeyphraseServer((configuration.host, configuration.port), service)
+    logger.info('Serving on http://{}:{}'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping server')
+    finally:
+        server.server_close()
 
 
 def main():
-    configuration = parse_args()
     set_system_encoding()
+    if sys.argv[1:2] == ['preprocess']:
+        CorpusPreprocessor(parse_preprocess_args(sys.argv[2:])).run()
+        return
+    if sys.argv[1:2] == ['serve']:
+        serve(parse_serve_args(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ['bench']:
+        return PipelineBenchmark(parse_bench_args(sys.argv[2:])).run()
+    if sys.argv[1:2] == ['startup-bench']:
+        return StartupBenchmark(parse_startup_bench_args(sys.argv[2:])).run()
+    configuration = parse_args(sys.argv[1:])
+    set_log_level(getattr(logging, configuration.log_level))
     system = System(configuration)
     system.run()
 
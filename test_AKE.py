@@ -0,0 +1,100 @@
+"""
+Checks that the ranking engines agree and that the HTTP service answers failing requests, run with:
+python -m unittest test_AKE
+"""
+
+import json
+import logging
+import random
+import threading
+import unittest
+import urllib2
+
+from AKE import KeyphraseServer, KeyphraseService, NetworkxRankingEngine, SparseRankingEngine
+
+
+class RankingEnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.networkx_engine = NetworkxRankingEngine()
+        self.sparse_engine = SparseRankingEngine()
+        self.random = random.Random(3)
+
+    def test_random_candidates(self):
+        for vocabulary_size, candidates_count in [(2, 10), (20, 100), (200, 5000), (3000, 20000)]:
+            candidates = [self.random.randrange(vocabulary_size) for _ in xrange(candidates_count)]
+            self.assert_ranks_agree(self.networkx_engine.rank(candidates), self.sparse_engine.rank(candidates))
+
+    def test_self_loops(self):
+        candidates = [1, 1, 2, 3, 3, 3, 1, 4, 4]
+        self.assert_ranks_agree(self.networkx_engine.rank(candidates), self.sparse_engine.rank(candidates))
+
+    def test_dangling_nodes(self):
+        # lone candidates of separate sequences become nodes without edges
+        sequences = [[1, 2, 3, 1], [4], [5, 5], [2, 6], [7]]
+        networkx_graph = self.networkx_engine.create_graph()
+        sparse_graph = self.sparse_engine.create_graph()
+        for candidates in sequences:
+            self.networkx_engine.add_candidates(networkx_graph, candidates)
+            self.sparse_engine.add_candidates(sparse_graph, candidates)
+        self.assert_ranks_agree(self.networkx_engine.rank_graph(networkx_graph),
+                                self.sparse_engine.rank_graph(sparse_graph))
+
+    def assert_ranks_agree(self, expected_ranks, ranks):
+        self.assertEqual(set(expected_ranks), set(ranks))
+        for node, rank in expected_ranks.iteritems():
+            self.assertAlmostEqual(rank, ranks[node], delta=self.sparse_engine.tolerance)
+
+
+class FailingKeyphraseService(KeyphraseService):
+    def extract(self, texts):
+        raise RuntimeError('extraction failed')
+
+
+class KeyphraseServerErrorsTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.server = KeyphraseServer(('127.0.0.1', 0), FailingKeyphraseService())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        logging.disable(logging.NOTSET)
+
+    def test_title_must_be_string(self):
+        status, response = self.post('/similarity', {'master': 'x', 'documents': [{'title': ['x'], 'text': 'y'}]})
+        self.assertEqual(400, status)
+        self.assertIn('Title of document 0', response['error'])
+
+    def test_titles_must_be_unique(self):
+        status, response = self.post('/similarity', {'master': 'x', 'documents': [{'title': 'a', 'text': 'y'},
+                                                                                  {'title': 'a', 'text': 'z'}]})
+        self.assertEqual(400, status)
+        self.assertIn('not unique', response['error'])
+
+    def test_internal_error(self):
+        errors_count = self.get_errors_count('/extract')
+        status, response = self.post('/extract', {'text': 'Python is a programming language.'})
+        self.assertEqual(500, status)
+        self.assertIn('RuntimeError', response['error'])
+        self.assertEqual(errors_count + 1, self.get_errors_count('/extract'))
+
+    def post(self, path, request):
+        try:
+            response = urllib2.urlopen(urllib2.Request(self.url + path, json.dumps(request),
+                                                       {'Content-Type': 'application/json'}))
+            return response.getcode(), json.load(response)
+        except urllib2.HTTPError as e:
+            return e.code, json.load(e)
+
+    def get_errors_count(self, endpoint):
+        counters = json.load(urllib2.urlopen(self.url + '/metrics'))['counters']
+        return sum(counter['value'] for counter in counters
+                   if counter['name'] == 'http_request_errors_total' and counter['labels'] == {'endpoint': endpoint})
+
+
+if __name__ == '__main__':
+    unittest.main()